@@ -0,0 +1,129 @@
+"""Холодный старт server.py: время импорта и первого /api/get-user.
+
+Импорт меряется в чистом процессе (python -c "import server"). Старт —
+uvicorn против заглушек Supabase и Bot API (bench/fakes.py) с сетевой
+задержкой: от запуска процесса до готовности, первый get-user и второй
+(уже тёплый) — для каждого режима WARMUP.
+
+    python bench/bench_startup.py
+    python bench/bench_startup.py --runs 5 --db-latency 0.08 --modes wait,background
+    python bench/bench_startup.py --importtime      # самые дорогие импорты
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from common import ROOT, make_init, free_port, spawn, wait_ready, stop_all  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_TOKEN = "123456:bench-token"
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import server; print(time.perf_counter() - t)"
+
+
+def import_times(runs):
+    out = []
+    for _ in range(runs):
+        r = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT,
+                           capture_output=True, text=True, check=True)
+        out.append(float(r.stdout.strip().splitlines()[-1]))
+    return out
+
+
+def top_imports(n=10):
+    """Модули, импортируемые прямо из server, по суммарному времени (-X importtime)"""
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"], cwd=ROOT,
+                       capture_output=True, text=True, check=True)
+    rows = []
+    for line in r.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        # прямые импорты server — на один уровень (два пробела) глубже него
+        if not name.startswith("   ") or name.startswith("     "):
+            continue
+        rows.append((int(parts[1]), name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+async def cold_start(mode, env, user_id):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = spawn(["-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+                  "--log-level", "warning"], {**env, "WARMUP": mode})
+    try:
+        await wait_ready(base + "/metrics", interval=0.01, attempts=3000)
+        ready = time.perf_counter() - t0
+        init = make_init(user_id, BOT_TOKEN)
+        async with httpx.AsyncClient(timeout=30) as c:
+            t1 = time.perf_counter()
+            r = await c.post(base + "/api/get-user", json={"initData": init})
+            first = time.perf_counter() - t1
+            r.raise_for_status()
+            t2 = time.perf_counter()
+            await c.post(base + "/api/get-user", json={"initData": make_init(user_id + 1, BOT_TOKEN)})
+            second = time.perf_counter() - t2
+        return ready, first, second
+    finally:
+        await stop_all([proc])
+
+
+def ms(values):
+    return f"{statistics.median(values) * 1000:8.1f}"
+
+
+async def main(args):
+    times = import_times(args.runs)
+    print(f"import server: медиана {ms(times).strip()} мс (min {min(times) * 1000:.1f}, runs {args.runs})")
+    if args.importtime:
+        print("\nсамые дорогие импорты (суммарно, мс):")
+        for us, name in top_imports():
+            print(f"  {us / 1000:8.1f}  {name}")
+
+    db_port, tg_port = free_port(), free_port()
+    fakes = os.path.join(HERE, "fakes.py")
+    procs = [
+        spawn([fakes, "db", "--port", str(db_port), "--latency", str(args.db_latency)]),
+        spawn([fakes, "tg", "--port", str(tg_port), "--latency", str(args.tg_latency)]),
+    ]
+    try:
+        await wait_ready(f"http://127.0.0.1:{db_port}/rest/v1/prizes")
+        await wait_ready(f"http://127.0.0.1:{tg_port}/stats")
+        env = {
+            **os.environ,
+            "BOT_TOKEN": BOT_TOKEN, "ADMIN_ID": "0",
+            "SUPABASE_URL": f"http://127.0.0.1:{db_port}", "SUPABASE_KEY": "bench",
+            "TG_API_URL": f"http://127.0.0.1:{tg_port}", "WEBHOOK_URL": "https://bench.invalid/api/webhook",
+        }
+        print(f"\nзадержка БД {args.db_latency * 1000:.0f} мс, Bot API {args.tg_latency * 1000:.0f} мс; "
+              f"медианы по {args.runs} запускам\n")
+        print(f"{'WARMUP':<11} {'готов мс':>8} {'1-й get':>8} {'2-й get':>8} {'до ответа':>10}")
+        user_id = 20_000_000
+        for mode in args.modes.split(","):
+            rows = []
+            for _ in range(args.runs):
+                rows.append(await cold_start(mode, env, user_id))
+                user_id += 2
+            ready, first, second = zip(*rows)
+            total = [r + f for r, f, _ in rows]
+            print(f"{mode:<11} {ms(ready)} {ms(first)} {ms(second)} {ms(total):>10}")
+    finally:
+        await stop_all(procs)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--modes", default="wait,background,off")
+    p.add_argument("--db-latency", type=float, default=0.05)
+    p.add_argument("--tg-latency", type=float, default=0.05)
+    p.add_argument("--importtime", action="store_true")
+    asyncio.run(main(p.parse_args()))
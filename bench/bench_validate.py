@@ -0,0 +1,54 @@
+"""Микро-бенчмарк проверки initData: старая реализация vs validate_init.
+
+    python bench/bench_validate.py [итераций]
+"""
+import os
+import sys
+import json
+import hmac
+import hashlib
+import timeit
+from urllib.parse import parse_qs, unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import server  # noqa: E402
+from common import make_init  # noqa: E402
+
+
+def legacy_validate(raw):
+    """validate_init в том виде, как он был до кэширования"""
+    try:
+        parsed = parse_qs(raw)
+        h = parsed.get("hash", [None])[0]
+        if not h:
+            return None
+        pairs = sorted(
+            f"{k}={unquote(v[0])}" for k, v in parsed.items() if k != "hash"
+        )
+        secret = hmac.new(b"WebAppData", server.BOT_TOKEN.encode(), hashlib.sha256).digest()
+        check = hmac.new(secret, "\n".join(pairs).encode(), hashlib.sha256).hexdigest()
+        if check != h:
+            return None
+        user_raw = parsed.get("user", [None])[0]
+        return {"user": json.loads(unquote(user_raw))} if user_raw else None
+    except:
+        return None
+
+
+def bench(name, fn, n):
+    sec = min(timeit.repeat(fn, number=n, repeat=5))
+    print(f"{name:<28} {sec / n * 1e6:8.2f} мкс/запрос")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    raw = make_init(123456789, server.BOT_TOKEN)
+    assert legacy_validate(raw) and server.validate_init(raw)
+
+    bench("старый validate_init", lambda: legacy_validate(raw), n)
+    bench("check_init (без кэша)", lambda: server.check_init(raw), n)
+    bench("validate_init (кэш)", lambda: server.validate_init(raw), n)
+
+
+if __name__ == "__main__":
+    main()
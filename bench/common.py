@@ -0,0 +1,66 @@
+"""Общее для бенчмарков: подпись initData, перцентили, запуск процессов."""
+import os
+import sys
+import json
+import hmac
+import time
+import socket
+import asyncio
+import hashlib
+import subprocess
+from urllib.parse import urlencode
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_init(user_id, token, first_name="Bench"):
+    """Подписанный initData, как его формирует Telegram"""
+    pairs = {
+        "auth_date": str(int(time.time())),
+        "query_id": f"AAH{user_id}",
+        "user": json.dumps({"id": user_id, "first_name": first_name, "username": f"u{user_id}",
+                            "language_code": "ru"}, separators=(",", ":")),
+    }
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    check = "\n".join(f"{k}={pairs[k]}" for k in sorted(pairs))
+    pairs["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(pairs)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn(args, env=None):
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, env=env)
+
+
+async def wait_ready(url, interval=0.1, attempts=150):
+    async with httpx.AsyncClient() as c:
+        for _ in range(attempts):
+            try:
+                await c.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(interval)
+    raise RuntimeError(f"{url} не поднялся")
+
+
+async def stop_all(procs):
+    """Останавливает процессы в обратном порядке: сервер раньше заглушек"""
+    for p in reversed(procs):
+        p.terminate()
+        try:
+            await asyncio.to_thread(p.wait, 15)
+        except subprocess.TimeoutExpired:
+            p.kill()
@@ -0,0 +1,227 @@
+"""Локальные заглушки Supabase (PostgREST) и Telegram Bot API для нагрузочных тестов.
+
+Обе — обычные FastAPI-приложения с данными в памяти. Задержка и доля ошибок
+настраиваются, чтобы проверять поведение сервера при медленных зависимостях.
+"""
+import json
+import time
+import random
+import asyncio
+import itertools
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+
+class Faults:
+    """Искусственная задержка (с разбросом ±50%) и доля ошибок"""
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def fail(self):
+        return self.error_rate and random.random() < self.error_rate
+
+
+# ══════════════════════════════════════════════════
+#  FAKE POSTGREST
+# ══════════════════════════════════════════════════
+_ids = itertools.count(1)
+
+DEFAULTS = {
+    "users": lambda: {"state": "new", "admin_state": "", "prize_key": None, "prize_name": None,
+                      "created_at": datetime.now(timezone.utc).isoformat()},
+    "channels": lambda: {"is_active": True, "added_at": datetime.now(timezone.utc).isoformat()},
+    "broadcasts": lambda: {"id": next(_ids), "created_at": datetime.now(timezone.utc).isoformat()},
+}
+
+
+def _norm(v):
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    return "null" if v is None else str(v)
+
+
+def _match(row, filters):
+    for col, cond in filters.items():
+        op, _, val = cond.partition(".")
+        cur = row.get(col)
+        if op == "eq" and _norm(cur) != val:
+            return False
+        if op == "neq" and _norm(cur) == val:
+            return False
+        if op == "is" and _norm(cur) != val:
+            return False
+        if op == "in" and _norm(cur) not in val.strip("()").split(","):
+            return False
+        if op == "gt" and not (cur is not None and float(cur) > float(val)):
+            return False
+    return True
+
+
+def make_postgrest(faults, seed=None):
+    """PostgREST в памяти: select/eq/order/limit, insert/upsert, PATCH, HEAD count"""
+    app = FastAPI()
+    tables = {name: [] for name in ("users", "channels", "prizes", "avatars", "broadcasts")}
+    for name, rows in (seed or {}).items():
+        tables[name] = [dict(r) for r in rows]
+    app.state.tables = tables
+    reserved = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+    def query(req, table):
+        params = dict(req.query_params)
+        filters = {k: v for k, v in params.items() if k not in reserved}
+        rows = [r for r in tables.setdefault(table, []) if _match(r, filters)]
+        if "order" in params:
+            col, _, direction = params["order"].partition(".")
+            rows.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=direction == "desc")
+        if "limit" in params:
+            rows = rows[:int(params["limit"])]
+        return rows
+
+    def project(rows, select):
+        if not select or select == "*":
+            return rows
+        cols = select.split(",")
+        if "count()" in cols:
+            # агрегат PostgREST: GROUP BY по остальным колонкам
+            keys = [c for c in cols if c != "count()"]
+            groups = {}
+            for r in rows:
+                k = tuple(r.get(c) for c in keys)
+                groups[k] = groups.get(k, 0) + 1
+            return [{**dict(zip(keys, k)), "count": n} for k, n in groups.items()]
+        return [{c: r.get(c) for c in cols} for r in rows]
+
+    @app.api_route("/rest/v1/{table}", methods=["GET", "HEAD", "POST", "PATCH"])
+    async def rest(table: str, req: Request):
+        await faults.delay()
+        if faults.fail():
+            return JSONResponse({"message": "injected error"}, 503)
+
+        if req.method == "HEAD":
+            n = len(query(req, table))
+            return Response(headers={"Content-Range": f"*/{n}"})
+
+        if req.method == "GET":
+            return project(query(req, table), req.query_params.get("select"))
+
+        body = json.loads(await req.body() or b"null")
+        if req.method == "PATCH":
+            rows = query(req, table)
+            for r in rows:
+                r.update(body)
+            return rows
+
+        # POST: insert или upsert (on_conflict + Prefer: resolution=...)
+        prefer = req.headers.get("prefer", "")
+        conflict = req.query_params.get("on_conflict")
+        out = []
+        for item in body if isinstance(body, list) else [body]:
+            existing = None
+            if conflict:
+                existing = next((r for r in tables[table] if r.get(conflict) == item.get(conflict)), None)
+            if existing is not None:
+                if "merge-duplicates" in prefer:
+                    existing.update(item)
+                    out.append(existing)
+                elif "ignore-duplicates" not in prefer:
+                    return JSONResponse({"code": "23505", "message": "duplicate key"}, 409)
+                continue
+            row = {**DEFAULTS.get(table, dict)(), **item}
+            tables[table].append(row)
+            out.append(row)
+        return JSONResponse(out, 201)
+
+    return app
+
+
+# ══════════════════════════════════════════════════
+#  FAKE BOT API
+# ══════════════════════════════════════════════════
+def make_bot_api(faults, member_rate=0.7, rate_limit_rate=0.0):
+    """Bot API: getChatMember отвечает «подписан» с вероятностью member_rate"""
+    app = FastAPI()
+    app.state.calls = {}
+    app.state.webhook = {}
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.calls
+
+    @app.post("/bot{token}/{method}")
+    async def call(token: str, method: str, req: Request):
+        app.state.calls[method] = app.state.calls.get(method, 0) + 1
+        await faults.delay()
+        if rate_limit_rate and random.random() < rate_limit_rate:
+            return JSONResponse({"ok": False, "error_code": 429,
+                                 "description": "Too Many Requests: retry after 1",
+                                 "parameters": {"retry_after": 1}}, 429)
+        if faults.fail():
+            return JSONResponse({"ok": False, "error_code": 502, "description": "Bad Gateway"}, 502)
+
+        data = json.loads(await req.body() or b"{}")
+        if method == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "username": "bench_bot"}}
+        if method == "getChatMember":
+            # детерминированно по паре, чтобы повторные проверки были согласованы
+            rnd = random.Random(f"{data.get('chat_id')}:{data.get('user_id')}")
+            status = "member" if rnd.random() < member_rate else "left"
+            return {"ok": True, "result": {"status": status, "user": {"id": data.get("user_id")}}}
+        if method == "getChat":
+            cid = int(data["chat_id"]) if str(data.get("chat_id", "")).lstrip("-").isdigit() else -1000
+            return {"ok": True, "result": {"id": cid, "type": "channel", "title": f"Channel {cid}",
+                                           "username": f"ch{abs(cid)}"}}
+        if method == "setWebhook":
+            app.state.webhook = {"url": data.get("url", ""), "allowed_updates": data.get("allowed_updates", []),
+                                 **{k: data[k] for k in ("max_connections", "ip_address") if k in data}}
+            return {"ok": True, "result": True}
+        if method == "getWebhookInfo":
+            return {"ok": True, "result": {"url": "", "pending_update_count": 0, **app.state.webhook}}
+        if method == "getChatMemberCount":
+            return {"ok": True, "result": 1000}
+        return {"ok": True, "result": {"message_id": int(time.time() * 1000) % 10**9}}
+
+    return app
+
+
+def seed(n_channels):
+    """Каналы-спонсоры и 13 призов, как в боевой базе"""
+    channels = [{
+        "channel_id": -1000000000000 - i, "title": f"Sponsor {i}", "username": f"sponsor{i}",
+        "invite_link": f"https://t.me/sponsor{i}", "avatar_hash": "", "avatar_uid": "",
+        "member_count": 1000, "is_active": True, "added_at": f"2026-01-01T00:00:{i:02d}Z",
+    } for i in range(n_channels)]
+    prizes = [{
+        "key": f"prize{i}", "name": f"Prize {i}", "emoji": "🎁", "tgs_file": f"assets/prize{i}.tgs",
+        "sort_order": i, "is_active": True,
+    } for i in range(1, 14)]
+    return {"channels": channels, "prizes": prizes}
+
+
+if __name__ == "__main__":
+    # отдельный процесс, чтобы заглушки не делили CPU с генератором нагрузки
+    import argparse
+    import uvicorn
+
+    p = argparse.ArgumentParser()
+    p.add_argument("kind", choices=("db", "tg"))
+    p.add_argument("--port", type=int, required=True)
+    p.add_argument("--latency", type=float, default=0.0)
+    p.add_argument("--errors", type=float, default=0.0)
+    p.add_argument("--channels", type=int, default=5)
+    p.add_argument("--member-rate", type=float, default=0.7)
+    p.add_argument("--rate-limit", type=float, default=0.0)
+    a = p.parse_args()
+    faults = Faults(a.latency, a.errors)
+    if a.kind == "db":
+        app = make_postgrest(faults, seed(a.channels))
+    else:
+        app = make_bot_api(faults, a.member_rate, a.rate_limit)
+    uvicorn.run(app, host="127.0.0.1", port=a.port, log_level="warning")
@@ -0,0 +1,179 @@
+"""Нагрузочный тест server.py против локальных заглушек Supabase и Bot API.
+
+Поднимает fake PostgREST и fake Bot API (bench/fakes.py) и сам сервер
+отдельными процессами, генерирует подписанный initData для N
+синтетических юзеров и гоняет смесь get-user / save_roll / check / webhook
+(join — событие chat_member «вступил в канал»).
+
+    python bench/loadtest.py --users 5000 --concurrency 100 --duration 30
+    python bench/loadtest.py --db-latency 0.05 --tg-latency 0.1 --tg-errors 0.02
+    python bench/loadtest.py --workers 4 --state sqlite:/tmp/state.db
+    python bench/loadtest.py --url http://127.0.0.1:8888   # уже запущенный сервер
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from common import make_init, percentile, free_port, spawn, wait_ready, stop_all  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_TOKEN = "123456:bench-token"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class Stats:
+    def __init__(self):
+        self.lat = {}
+        self.errors = {}
+        self.client_errors = {}
+
+    def add(self, kind, seconds, status):
+        self.lat.setdefault(kind, []).append(seconds)
+        if status is None or status >= 500:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+        elif status >= 400:
+            self.client_errors[kind] = self.client_errors.get(kind, 0) + 1
+
+    def report(self, elapsed):
+        rows = []
+        everything = []
+        for kind, values in sorted(self.lat.items()):
+            everything += values
+            rows.append((kind, sorted(values)))
+        rows.append(("ВСЕГО", sorted(everything)))
+        print(f"\n{'запрос':<10} {'n':>7} {'rps':>8} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'4xx':>6} {'ошибок':>7}")
+        for kind, v in rows:
+            e = sum(self.errors.values()) if kind == "ВСЕГО" else self.errors.get(kind, 0)
+            c = sum(self.client_errors.values()) if kind == "ВСЕГО" else self.client_errors.get(kind, 0)
+            print(f"{kind:<10} {len(v):>7} {len(v) / elapsed:>8.1f} "
+                  f"{percentile(v, 0.5) * 1000:>8.1f} {percentile(v, 0.95) * 1000:>8.1f} "
+                  f"{percentile(v, 0.99) * 1000:>8.1f} {c:>6} {e:>7}")
+
+
+async def run_load(base, args):
+    users = list(range(10_000_000, 10_000_000 + args.users))
+    init_data = {u: make_init(u, BOT_TOKEN) for u in users}
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    stats = Stats()
+    update_id = iter(range(1, 10**9))
+    deadline = time.perf_counter() + args.duration
+
+    async def one(client):
+        uid = random.choice(users)
+        kind = random.choices(kinds, weights)[0]
+        if kind == "get":
+            req = ("/api/get-user", {"initData": init_data[uid]})
+        elif kind == "roll":
+            req = ("/api/check-subscription", {"initData": init_data[uid], "action": "save_roll",
+                                               "prize_key": "prize1", "prize_name": "Prize 1"})
+        elif kind == "check":
+            req = ("/api/check-subscription", {"initData": init_data[uid], "action": "check"})
+        elif kind == "join":
+            chat = {"id": -1000000000000 - random.randrange(args.channels), "type": "channel"}
+            req = ("/api/webhook", {"update_id": next(update_id), "chat_member": {
+                "chat": chat, "from": {"id": uid}, "date": int(time.time()),
+                "old_chat_member": {"status": "left", "user": {"id": uid}},
+                "new_chat_member": {"status": "member", "user": {"id": uid}}}})
+        else:
+            req = ("/api/webhook", {"update_id": next(update_id), "message": {
+                "message_id": 1, "text": "/start", "from": {"id": uid, "first_name": "Bench"},
+                "chat": {"id": uid, "type": "private"}}})
+        t0 = time.perf_counter()
+        try:
+            r = await client.post(base + req[0], json=req[1])
+            status = r.status_code
+        except httpx.HTTPError:
+            status = None
+        stats.add(kind, time.perf_counter() - t0, status)
+
+    async def worker(client):
+        while time.perf_counter() < deadline:
+            await one(client)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        # прогрев: первый запрос собирает статику и бандлы
+        await client.post(base + "/api/get-user", json={"initData": init_data[users[0]]})
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+    stats.report(elapsed)
+
+
+async def main(args):
+    procs = []
+    base = args.url
+    tg_url = None
+    try:
+        if not base:
+            db_port, tg_port, app_port = free_port(), free_port(), free_port()
+            fakes = os.path.join(HERE, "fakes.py")
+            procs.append(spawn([fakes, "db", "--port", str(db_port), "--channels", str(args.channels),
+                                "--latency", str(args.db_latency), "--errors", str(args.db_errors)]))
+            procs.append(spawn([fakes, "tg", "--port", str(tg_port), "--member-rate", str(args.member_rate),
+                                "--latency", str(args.tg_latency), "--errors", str(args.tg_errors),
+                                "--rate-limit", str(args.tg_429)]))
+            tg_url = f"http://127.0.0.1:{tg_port}"
+            await wait_ready(f"http://127.0.0.1:{db_port}/rest/v1/prizes")
+            await wait_ready(tg_url + "/stats")
+
+            env = {
+                **os.environ,
+                "BOT_TOKEN": BOT_TOKEN, "ADMIN_ID": "0",
+                "SUPABASE_URL": f"http://127.0.0.1:{db_port}", "SUPABASE_KEY": "bench",
+                "TG_API_URL": tg_url, "WEBHOOK_URL": "https://bench.invalid/api/webhook",
+            }
+            # несколько воркеров без общего состояния — не то, что идёт в прод
+            state = args.state or ("memory" if args.workers == 1 else
+                                   "sqlite:" + os.path.join(tempfile.mkdtemp(), "state.db"))
+            env["STATE_BACKEND"] = state
+            procs.append(spawn(["-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                                "--port", str(app_port), "--workers", str(args.workers),
+                                "--log-level", "warning"], env))
+            base = f"http://127.0.0.1:{app_port}"
+            await wait_ready(base + "/metrics")
+
+        print(f"сервер: {base}, воркеров: {args.workers}, юзеров: {args.users}, "
+              f"параллельно: {args.concurrency}, {args.duration} с, смесь: {args.mix}")
+        await run_load(base, args)
+        if tg_url:
+            async with httpx.AsyncClient() as c:
+                print(f"\nвызовов Bot API: {(await c.get(tg_url + '/stats')).json()}")
+    finally:
+        # сервер первым: при остановке он ещё дописывает в заглушки
+        await stop_all(procs)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--url", help="нагружать уже запущенный сервер (без заглушек)")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--duration", type=float, default=15)
+    p.add_argument("--workers", type=int, default=1, help="воркеров uvicorn")
+    p.add_argument("--state", help="STATE_BACKEND сервера (по умолчанию при --workers > 1 — "
+                                   "sqlite во временном файле)")
+    p.add_argument("--mix", default="get=5,roll=1,check=3,webhook=1")
+    p.add_argument("--channels", type=int, default=5)
+    p.add_argument("--member-rate", type=float, default=0.7)
+    p.add_argument("--db-latency", type=float, default=0.02)
+    p.add_argument("--db-errors", type=float, default=0.0)
+    p.add_argument("--tg-latency", type=float, default=0.05)
+    p.add_argument("--tg-errors", type=float, default=0.0)
+    p.add_argument("--tg-429", type=float, default=0.0, help="доля ответов 429")
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,95 @@
+"""Гонка save_roll: параллельные броски одного юзера — выиграть должен ровно один.
+
+Для каждого юзера одновременно уходит --parallel запросов save_roll с разными
+призами. Ожидание: один ответ 200, остальные 400 "Already rolled", и в БД
+после остановки сервера (write-behind успевает дописать) — приз победителя.
+
+    python bench/race_roll.py
+    python bench/race_roll.py --write-behind --users 50 --parallel 5
+    python bench/race_roll.py --write-behind --workers 2 --state sqlite:/tmp/state.db
+"""
+import os
+import sys
+import asyncio
+import argparse
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from common import make_init, free_port, spawn, wait_ready, stop_all  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_TOKEN = "123456:bench-token"
+
+
+async def race(c, base, user_id, parallel):
+    """Ключ приза выигравшего запроса (None — если выиграли не ровно один)"""
+    init = make_init(user_id, BOT_TOKEN)
+    keys = [f"prize{i + 1}" for i in range(parallel)]
+    rs = await asyncio.gather(*(
+        c.post(base + "/api/check-subscription",
+               json={"initData": init, "action": "save_roll", "prize_key": k, "prize_name": k})
+        for k in keys))
+    won = [k for k, r in zip(keys, rs) if r.status_code == 200]
+    return won[0] if len(won) == 1 else None
+
+
+async def main(args):
+    db_port, tg_port, app_port = free_port(), free_port(), free_port()
+    db_url = f"http://127.0.0.1:{db_port}"
+    fakes = os.path.join(HERE, "fakes.py")
+    procs = [
+        spawn([fakes, "db", "--port", str(db_port), "--latency", str(args.db_latency)]),
+        spawn([fakes, "tg", "--port", str(tg_port)]),
+    ]
+    try:
+        await wait_ready(db_url + "/rest/v1/prizes")
+        await wait_ready(f"http://127.0.0.1:{tg_port}/stats")
+        tmp = tempfile.mkdtemp()
+        env = {
+            **os.environ,
+            "BOT_TOKEN": BOT_TOKEN, "ADMIN_ID": "0",
+            "SUPABASE_URL": db_url, "SUPABASE_KEY": "bench",
+            "TG_API_URL": f"http://127.0.0.1:{tg_port}", "WEBHOOK_URL": "https://bench.invalid/api/webhook",
+            "WRITE_BEHIND": "1" if args.write_behind else "0", "WB_SPOOL": os.path.join(tmp, "users.wal"),
+            "STATE_BACKEND": args.state or ("memory" if args.workers == 1 else
+                                            "sqlite:" + os.path.join(tmp, "state.db")),
+        }
+        server = spawn(["-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(app_port),
+                        "--workers", str(args.workers), "--log-level", "warning"], env)
+        base = f"http://127.0.0.1:{app_port}"
+        await wait_ready(base + "/metrics")
+
+        ids = range(30_000_000, 30_000_000 + args.users)
+        async with httpx.AsyncClient(timeout=30) as c:
+            winners = await asyncio.gather(*(race(c, base, uid, args.parallel) for uid in ids))
+        await stop_all([server])  # write-behind дописывает буфер при остановке
+
+        async with httpx.AsyncClient() as c:
+            rows = (await c.get(db_url + "/rest/v1/users",
+                                params={"telegram_id": f"gt.{ids[0] - 1}"})).json()
+        saved = {r["telegram_id"]: r.get("prize_key") for r in rows}
+        bad = [(uid, won, saved.get(uid)) for uid, won in zip(ids, winners)
+               if won is None or saved.get(uid) != won]
+        print(f"write-behind: {'да' if args.write_behind else 'нет'}, воркеров: {args.workers}, "
+              f"юзеров: {args.users} × {args.parallel} бросков")
+        if bad:
+            print(f"ОШИБКА: {len(bad)} юзеров — не один победитель или в БД чужой приз")
+            for uid, won, got in bad[:10]:
+                print(f"  {uid}: выиграл {won}, в БД {got}")
+            sys.exit(1)
+        print("ок: у каждого ровно один выигравший бросок, в БД — его приз")
+    finally:
+        await stop_all(procs)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--parallel", type=int, default=3, help="одновременных бросков на юзера")
+    p.add_argument("--write-behind", action="store_true")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--state", help="STATE_BACKEND сервера")
+    p.add_argument("--db-latency", type=float, default=0.02)
+    asyncio.run(main(p.parse_args()))
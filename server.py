@@ -1,14 +1,23 @@
 import os
 import json
+import time
+import asyncio
 import hmac
 import hashlib
 import base64
-from urllib.parse import parse_qs, unquote
+import gzip
+import io
+import mimetypes
+import importlib.util
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qsl
 
 import httpx
 from fastapi import FastAPI, Request
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
+from starlette.datastructures import MutableHeaders
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,18 +25,606 @@ load_dotenv()
 BOT_TOKEN    = os.getenv("BOT_TOKEN", "")
 WEBAPP_URL   = os.getenv("WEBAPP_URL", "")
 ADMIN_ID     = int(os.getenv("ADMIN_ID", "0"))
+# дополнительные админы через запятую; ADMIN_ID остаётся главным
+ADMIN_IDS    = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x} \
+               | ({ADMIN_ID} if ADMIN_ID else set())
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 
-app = FastAPI()
+# Пул соединений к Supabase
+DB_MAX_CONN  = int(os.getenv("DB_MAX_CONN", "20"))
+DB_KEEPALIVE = int(os.getenv("DB_KEEPALIVE", "10"))
+DB_TIMEOUT   = float(os.getenv("DB_TIMEOUT", "15"))
+
+# Telegram Bot API: адрес (для локального стенда), лимиты и ретраи
+TG_API_URL    = os.getenv("TG_API_URL", "https://api.telegram.org")
+TG_GLOBAL_RPS = float(os.getenv("TG_GLOBAL_RPS", "30"))    # отправка сообщений
+TG_READ_RPS   = float(os.getenv("TG_READ_RPS", "100"))     # getChatMember и прочие чтения
+TG_CHAT_RPS   = float(os.getenv("TG_CHAT_RPS", "1"))
+TG_RETRIES    = int(os.getenv("TG_RETRIES", "3"))
+TG_TIMEOUT    = float(os.getenv("TG_TIMEOUT", "15"))
+
+# Проверка подписки: сколько getChatMember параллельно и общий дедлайн (сек)
+CHECK_CONCURRENCY = int(os.getenv("CHECK_CONCURRENCY", "8"))
+CHECK_DEADLINE    = float(os.getenv("CHECK_DEADLINE", "5"))
+
+# Кэш подписок: «подписан» живёт долго, «не подписан» — коротко
+MEMBER_POS_TTL    = float(os.getenv("MEMBER_POS_TTL", "600"))
+MEMBER_NEG_TTL    = float(os.getenv("MEMBER_NEG_TTL", "10"))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "50000"))
+
+# Подписки по событиям chat_member: сколько живёт запись индекса, адрес вебхука
+# для регистрации allowed_updates (пусто — текущий из getWebhookInfo) и темп бэкфилла
+MEMBER_INDEX_TTL = float(os.getenv("MEMBER_INDEX_TTL", str(7 * 24 * 3600)))
+WEBHOOK_URL      = os.getenv("WEBHOOK_URL", "")
+BACKFILL_RPS     = float(os.getenv("BACKFILL_RPS", "20"))
+
+# Кэш списков каналов/призов; TTL — на случай правок прямо в Supabase
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", "60"))
+
+# Аватарки каналов: сторона квадрата после ресайза (если есть Pillow)
+AVATAR_SIZE = int(os.getenv("AVATAR_SIZE", "128"))
+
+# Статистика в админке считается в БД и кэшируется на STATS_TTL секунд
+STATS_TTL = float(os.getenv("STATS_TTL", "15"))
+
+# Короткий кэш строк users, чтобы один сценарий не читал юзера по нескольку раз
+USER_CACHE_TTL  = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+# Вебхук: апдейты обрабатываются в фоне пулом воркеров
+WEBHOOK_WORKERS    = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_SECRET     = os.getenv("WEBHOOK_SECRET", "")
+
+# «Обновить каналы»: сколько каналов парсим одновременно
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", "4"))
+
+# initData: срок жизни по auth_date (0 — не проверять) и размер кэша проверок
+INIT_MAX_AGE    = int(os.getenv("INIT_MAX_AGE", "86400"))
+INIT_CACHE_SIZE = int(os.getenv("INIT_CACHE_SIZE", "10000"))
+
+# Статика: всё из PUBLIC_DIR читается и сжимается один раз при старте
+PUBLIC_DIR = os.getenv("PUBLIC_DIR", "public")
+
+# Lottie-бандл: знаков после запятой (0 — не округлять), целевой fps (0 — как есть)
+LOTTIE_PRECISION = int(os.getenv("LOTTIE_PRECISION", "3"))
+LOTTIE_FPS       = int(os.getenv("LOTTIE_FPS", "0"))
+
+# Диалоги админки: сколько живёт незавершённый шаг и писать ли его в users.admin_state
+ADMIN_STATE_TTL     = float(os.getenv("ADMIN_STATE_TTL", "900"))
+ADMIN_STATE_PERSIST = os.getenv("ADMIN_STATE_PERSIST", "0") == "1"
+
+# Write-behind для users: копим изменения и пишем пачками (по размеру или по времени)
+WRITE_BEHIND      = os.getenv("WRITE_BEHIND", "0") == "1"
+WB_BATCH_SIZE     = int(os.getenv("WB_BATCH_SIZE", "500"))
+WB_FLUSH_INTERVAL = float(os.getenv("WB_FLUSH_INTERVAL", "1.0"))
+WB_SPOOL          = os.getenv("WB_SPOOL", "users.wal")
+
+# Рассылка: свой темп ниже лимита Telegram (~30/с), параллельность и размер страницы users
+BCAST_RPS         = float(os.getenv("BCAST_RPS", "25"))
+BCAST_CONCURRENCY = int(os.getenv("BCAST_CONCURRENCY", "20"))
+BCAST_PAGE        = int(os.getenv("BCAST_PAGE", "500"))
+
+# Общее состояние воркеров (кэши, лимиты Telegram, дедуп апдейтов):
+# memory — в процессе (один воркер), sqlite:<путь> — общий файл для uvicorn --workers N
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+
+# Старт: wait — прогреть пулы и кэши до приёма запросов, background — принимать
+# сразу и греть в фоне (первый запрос дождётся нужного сам), off — всё по первому обращению
+WARMUP = os.getenv("WARMUP", "wait")
+
+# /metrics: если задан токен — нужен заголовок Authorization: Bearer <token>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# HTTP/2 — только если установлен пакет h2 (pip install httpx[http2]);
+# сам h2 импортирует httpx, когда откроет клиент
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+# Pillow необязателен: без него аватарка хранится как прислал Telegram (160px).
+# Импорт тяжёлый, а нужен только для аватарок — грузится в resize_avatar
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+
+# brotli необязателен: без него статика отдаётся только в gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+@asynccontextmanager
+async def lifespan(app):
+    await db.open()
+    await bot.open()
+    await writes.start()
+    updates.start()
+    # регистрация chat_member не должна задерживать старт, если Telegram тормозит
+    background = [asyncio.create_task(ensure_webhook()), asyncio.create_task(migrate_avatars())]
+    if WARMUP == "wait":
+        await warmup()
+    elif WARMUP == "background":
+        background.append(asyncio.create_task(warmup()))
+    try:
+        yield
+    finally:
+        for t in background:
+            t.cancel()
+        await broadcaster.stop(wait=True)
+        await updates.stop()
+        await admin_sessions.flush()
+        await writes.stop()
+        await bot.close()
+        await db.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# ══════════════════════════════════════════════════
+#  IN-MEMORY CACHE
+# ══════════════════════════════════════════════════
+class TTLCache:
+    """LRU-кэш с ограничением размера и TTL на каждую запись"""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.data = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is not None:
+            value, expires = item
+            if expires > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """Записать, только если ключа нет (или он истёк); True — записали мы"""
+        item = self.data.get(key)
+        if item is not None and item[1] > time.monotonic():
+            return False
+        self.set(key, value, ttl)
+        return True
+
+    def pop(self, key):
+        item = self.data.pop(key, None)
+        return item[0] if item else None
+
+    def drop_where(self, pred):
+        for key in [k for k in self.data if pred(k)]:
+            del self.data[key]
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+_MISS = object()
+
+
+class ReadThrough:
+    """Версионированный read-through кэш одного значения (single-flight загрузка).
+
+    С общим STATE_BACKEND и name версия хранится ещё и в cache_versions:
+    invalidate() в любом воркере делает значение устаревшим во всех.
+    """
+
+    def __init__(self, loader, ttl=60, name=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.name = name if state.shared else None
+        self.token = None
+        self.version = 0
+        self.value = None
+        self.expires = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.lock = asyncio.Lock()
+
+    def _fresh(self):
+        if self.value is None or self.expires <= time.monotonic():
+            return False
+        return self.name is None or cache_versions.get(self.name) == self.token
+
+    async def get(self):
+        if self._fresh():
+            self.hits += 1
+            return self.value
+        async with self.lock:
+            if self._fresh():
+                self.hits += 1
+                return self.value
+            self.misses += 1
+            version = self.version
+            token = cache_versions.get(self.name) if self.name else None
+            value = await self.loader()
+            # пустой ответ может быть ошибкой Supabase — не кэшируем его;
+            # если во время загрузки был invalidate(), данные уже устарели
+            if value and version == self.version:
+                self.value = value
+                self.token = token
+                self.expires = time.monotonic() + self.ttl
+            return value
+
+    def invalidate(self):
+        self.version += 1
+        self.value = None
+        if self.name:
+            cache_versions.set(self.name, time.time_ns())
+
+    def stats(self):
+        return {"version": self.version, "hits": self.hits, "misses": self.misses}
+
+# ══════════════════════════════════════════════════
+#  STATE BACKEND
+# ══════════════════════════════════════════════════
+class MemoryState:
+    """Кэши и лимиты в памяти процесса — для одного воркера"""
+
+    shared = False
+
+    def cache(self, name, maxsize=10000, ttl=60):
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def bucket(self, name, rate, burst=None):
+        return TokenBucket(rate, burst)
+
+
+class SQLiteState:
+    """Общие для всех воркеров кэши и лимиты в одном файле SQLite (WAL).
+
+    Запросы короткие и синхронные: локальный файл отвечает за десятки
+    микросекунд. Время — time.time(), чтобы сроки совпадали между процессами.
+    Ожидание чужой блокировки — не дольше BUSY_TIMEOUT, иначе воркер стоит
+    целиком: лимиты ждут асинхронно, чтения считаются промахом.
+    """
+
+    shared = True
+    MAINTAIN_EVERY = 1000
+    BUSY_TIMEOUT = 0.05
+    BUSY_RETRY = 0.01
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.conn = None
+        self.writes = 0
+        self.busy = sqlite3.OperationalError  # «database is locked»
+
+    def db(self):
+        if self.conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # состояние эфемерное
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS kv (
+                    ns TEXT, key TEXT, value TEXT, expires REAL,
+                    PRIMARY KEY (ns, key)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS kv_expires ON kv (ns, expires);
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY, tokens REAL, ts REAL, paused_until REAL) WITHOUT ROWID;
+            """)
+            self.conn = conn
+        return self.conn
+
+    def write(self, sql, params=()):
+        cur = self.db().execute(sql, params)
+        self.writes += 1
+        if self.writes % self.MAINTAIN_EVERY == 0:
+            self.maintain()
+        return cur
+
+    def maintain(self):
+        """Выкидывает истёкшие ключи и давно простаивающие лимиты чатов"""
+        now = time.time()
+        self.db().execute("DELETE FROM kv WHERE expires <= ?", (now,))
+        self.db().execute("DELETE FROM buckets WHERE ts < ? AND paused_until < ?", (now - 600, now))
+
+    def cache(self, name, maxsize=10000, ttl=60):
+        return SharedCache(self, name, maxsize=maxsize, ttl=ttl)
+
+    def bucket(self, name, rate, burst=None):
+        return SharedBucket(self, name, rate, burst)
+
+
+class SharedCache:
+    """TTLCache поверх SQLiteState: тот же интерфейс, значения и ключи в JSON"""
+
+    def __init__(self, state, name, maxsize=10000, ttl=60):
+        self.state = state
+        self.ns = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sets = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _decode_key(raw):
+        key = json.loads(raw)
+        return tuple(key) if isinstance(key, list) else key
+
+    def get(self, key, default=None):
+        try:
+            row = self.state.db().execute("SELECT value, expires FROM kv WHERE ns = ? AND key = ?",
+                                          (self.ns, json.dumps(key))).fetchone()
+        except self.state.busy:
+            row = None  # файл занят другим воркером — считаем промахом
+        if row and row[1] > time.time():
+            self.hits += 1
+            return json.loads(row[0])
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self.state.write("INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)",
+                         (self.ns, json.dumps(key), json.dumps(value), expires))
+        self.sets += 1
+        if self.sets % self.state.MAINTAIN_EVERY == 0:
+            self._trim()
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        cur = self.state.write(
+            "INSERT INTO kv VALUES (?, ?, ?, ?) ON CONFLICT (ns, key) DO UPDATE "
+            "SET value = excluded.value, expires = excluded.expires WHERE kv.expires <= ?",
+            (self.ns, json.dumps(key), json.dumps(value), now + (self.ttl if ttl is None else ttl), now))
+        return cur.rowcount == 1
+
+    def pop(self, key):
+        value = self.get(key)
+        self.state.write("DELETE FROM kv WHERE ns = ? AND key = ?", (self.ns, json.dumps(key)))
+        return value
+
+    def drop_where(self, pred):
+        keys = [(self.ns, raw) for (raw,) in
+                self.state.db().execute("SELECT key FROM kv WHERE ns = ?", (self.ns,))
+                if pred(self._decode_key(raw))]
+        self.state.db().executemany("DELETE FROM kv WHERE ns = ? AND key = ?", keys)
+
+    def clear(self):
+        self.state.write("DELETE FROM kv WHERE ns = ?", (self.ns,))
+
+    def _trim(self):
+        # вместо LRU — сначала те, что истекут раньше
+        extra = len(self) - self.maxsize
+        if extra > 0:
+            self.state.write("DELETE FROM kv WHERE ns = ? AND key IN "
+                             "(SELECT key FROM kv WHERE ns = ? ORDER BY expires LIMIT ?)",
+                             (self.ns, self.ns, extra))
+
+    def __len__(self):
+        return self.state.db().execute("SELECT count(*) FROM kv WHERE ns = ? AND expires > ?",
+                                       (self.ns, time.time())).fetchone()[0]
+
+    def stats(self):
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class SharedBucket:
+    """TokenBucket, общий для всех воркеров: запас токенов — строка в SQLite"""
+
+    def __init__(self, state, name, rate, burst=None):
+        self.state = state
+        self.key = name
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0  # своя копия паузы — на случай занятого файла
+
+    def pause(self, seconds):
+        now = time.time()
+        self.paused_until = max(self.paused_until, now + seconds)
+        try:
+            self.state.write(
+                "INSERT INTO buckets VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE "
+                "SET paused_until = max(paused_until, excluded.paused_until)",
+                (self.key, self.capacity, now, now + seconds))
+        except self.state.busy:
+            print(f"State backend busy: pause of {self.key} applies to this worker only")
+
+    def _take(self):
+        """0 — токен взят, иначе сколько секунд подождать"""
+        now = time.time()
+        if now < self.paused_until:
+            return self.paused_until - now
+        db = self.state.db()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+        except self.state.busy:
+            return self.state.BUSY_RETRY  # файл занят — подождём, не блокируя event loop
+        try:
+            now = time.time()
+            row = db.execute("SELECT tokens, ts, paused_until FROM buckets WHERE key = ?",
+                             (self.key,)).fetchone()
+            tokens, ts, paused_until = row or (self.capacity, now, 0.0)
+            if now < paused_until:
+                wait = paused_until - now
+            else:
+                tokens = min(self.capacity, tokens + (now - ts) * self.rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+                if not wait:
+                    tokens -= 1
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                           (self.key, tokens, now, paused_until))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return wait
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                wait = self._take()
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+
+def make_state(spec):
+    if spec.startswith("sqlite:"):
+        return SQLiteState(spec[len("sqlite:"):] or "state.db")
+    if spec != "memory":
+        print(f"Unknown STATE_BACKEND {spec!r}, using memory")
+    return MemoryState()
+
+state = make_state(STATE_BACKEND)
+# версии ReadThrough-кэшей: invalidate() в одном воркере сбрасывает их во всех
+cache_versions = state.cache("versions", maxsize=1000, ttl=7 * 24 * 3600)
+
+# ══════════════════════════════════════════════════
+#  METRICS
+# ══════════════════════════════════════════════════
+class Metrics:
+    """Минимальные счётчики и гистограммы в формате Prometheus (без prometheus_client)"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters = {}    # (имя, метки) → значение
+        self.histograms = {}  # (имя, метки) → [счётчики бакетов, сумма, количество]
+        self.collectors = []  # функции → [(имя, тип, метки, значение)] на момент отдачи
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, b in enumerate(self.BUCKETS):
+            if seconds <= b:
+                h[0][i] += 1
+        h[1] += seconds
+        h[2] += 1
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        lines, typed = [], set()
+
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), v in sorted(self.counters.items()):
+            type_line(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {v}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            type_line(name, "histogram")
+            for b, n in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', b)])} {n}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        samples = [x for fn in self.collectors for x in fn()]
+        for name, kind, labels, v in sorted(samples, key=lambda x: x[0]):
+            type_line(name, kind)
+            lines.append(f"{name}{self._labels(sorted(labels.items()))} {v}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+# Отрезки времени текущего HTTP-запроса для заголовка Server-Timing
+request_spans = ContextVar("request_spans", default=None)
+
+def track(kind, name, seconds, **labels):
+    """Внешний вызов: в гистограмму и в Server-Timing текущего запроса"""
+    metrics.observe(f"{kind}_request_seconds", seconds, **labels)
+    spans = request_spans.get()
+    if spans is not None:
+        spans.append((kind, name, seconds))
+
+def server_timing(spans, total):
+    agg = {}
+    for kind, name, sec in spans:
+        key = f"{kind}-{name}"
+        dur, n = agg.get(key, (0.0, 0))
+        agg[key] = (dur + sec, n + 1)
+    parts = [f'{k};dur={d * 1000:.1f};desc="{n}x"' for k, (d, n) in agg.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+def metric_route(path):
+    """Метка маршрута без взрыва кардинальности: /api/* как есть, статика — по префиксу"""
+    if path.startswith("/api/") or path == "/metrics":
+        return path
+    head = path.split("/")[1] if path.count("/") > 1 else ""
+    return f"/{head}" if head in ("avatars", "bundles", "assets") else "/static"
+
+
+class TimingMiddleware:
+    """Время каждого запроса → http_request_seconds и заголовок Server-Timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        spans = []
+        token = request_spans.set(spans)
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append(
+                    "Server-Timing", server_timing(spans, time.perf_counter() - t0))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            request_spans.reset(token)
+            route = metric_route(scope["path"])
+            metrics.observe("http_request_seconds", time.perf_counter() - t0,
+                            route=route, method=scope["method"])
+            metrics.inc("http_requests_total", route=route, status=status)
+
+app.add_middleware(TimingMiddleware)
 
 # ══════════════════════════════════════════════════
 #  SUPABASE REST CLIENT (без SDK — без проблем)
 # ══════════════════════════════════════════════════
 class SupabaseREST:
-    """Простой клиент для Supabase через REST API"""
+    """Асинхронный клиент для Supabase через REST API (один пул на процесс)"""
 
-    def __init__(self, url, key):
+    def __init__(self, url, key, max_connections=20, max_keepalive=10, timeout=15):
         self.base = f"{url}/rest/v1"
         self.headers = {
             "apikey": key,
@@ -35,63 +632,290 @@ class SupabaseREST:
             "Content-Type": "application/json",
             "Prefer": "return=representation",
         }
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+        )
+        self.timeout = timeout
+        self.client = None
+
+    async def open(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2, limits=self.limits, timeout=self.timeout,
+                headers=self.headers,
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
 
-    def _req(self, method, table, params=None, data=None, headers_extra=None):
+    async def _req(self, method, table, params=None, data=None, headers_extra=None, strict=False):
+        """strict=True — при ошибке None вместо [], чтобы «нет строк» не путать со сбоем"""
+        fail = None if strict else []
+        if self.client is None:
+            await self.open()
         url = f"{self.base}/{table}"
-        h = {**self.headers}
-        if headers_extra:
-            h.update(headers_extra)
-        with httpx.Client() as client:
-            r = client.request(method, url, params=params, json=data, headers=h, timeout=15)
-            if r.status_code >= 400:
-                print(f"Supabase error: {r.status_code} {r.text}")
-                return []
-            try:
-                return r.json()
-            except:
-                return []
+        t0 = time.perf_counter()
+        try:
+            r = await self.client.request(method, url, params=params, json=data,
+                                          headers=headers_extra)
+        except httpx.HTTPError as e:
+            print(f"Supabase error: {method} {table} {e!r}")
+            metrics.inc("supabase_errors_total", table=table, method=method)
+            return fail
+        finally:
+            track("supabase", table, time.perf_counter() - t0, table=table, method=method)
+        if r.status_code >= 400:
+            print(f"Supabase error: {r.status_code} {r.text}")
+            metrics.inc("supabase_errors_total", table=table, method=method)
+            return fail
+        try:
+            return r.json()
+        except:
+            return fail
 
-    def select(self, table, filters=None, order=None, limit=None):
-        params = {"select": "*"}
+    async def select(self, table, filters=None, order=None, limit=None, columns="*", strict=False):
+        params = {"select": columns}
         if filters:
             params.update(filters)
         if order:
             params["order"] = order
         if limit:
             params["limit"] = str(limit)
-        return self._req("GET", table, params=params)
-
-    def insert(self, table, data):
-        return self._req("POST", table, data=data)
+        return await self._req("GET", table, params=params, strict=strict)
 
-    def update(self, table, data, filters):
+    async def count(self, table, filters=None):
+        """Количество строк по фильтру — считает сама БД, строки не скачиваются;
+        None — запрос не удался (не путать с нулём)"""
+        if self.client is None:
+            await self.open()
+        params = {"select": "*"}
+        if filters:
+            params.update(filters)
+        t0 = time.perf_counter()
+        try:
+            r = await self.client.head(f"{self.base}/{table}", params=params,
+                                       headers={"Prefer": "count=exact"})
+        except httpx.HTTPError as e:
+            print(f"Supabase error: HEAD {table} {e!r}")
+            metrics.inc("supabase_errors_total", table=table, method="HEAD")
+            return None
+        finally:
+            track("supabase", table, time.perf_counter() - t0, table=table, method="HEAD")
+        if r.status_code >= 400:
+            print(f"Supabase error: {r.status_code} count {table}")
+            metrics.inc("supabase_errors_total", table=table, method="HEAD")
+            return None
+        # Content-Range: 0-24/3573 или */0
+        total = r.headers.get("content-range", "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+
+    async def insert(self, table, data):
+        return await self._req("POST", table, data=data)
+
+    async def upsert(self, table, data, on_conflict, ignore=False):
+        resolution = "ignore-duplicates" if ignore else "merge-duplicates"
+        return await self._req("POST", table, params={"on_conflict": on_conflict}, data=data,
+                               headers_extra={"Prefer": f"resolution={resolution},return=representation"})
+
+    async def bulk_upsert(self, table, rows, on_conflict, ignore=False):
+        """Пачка строк одним POST; True — если PostgREST принял всю пачку"""
+        resolution = "ignore-duplicates" if ignore else "merge-duplicates"
+        if self.client is None:
+            await self.open()
+        t0 = time.perf_counter()
+        try:
+            r = await self.client.post(f"{self.base}/{table}", params={"on_conflict": on_conflict},
+                                       json=rows, headers={"Prefer": f"resolution={resolution},return=minimal"})
+        except httpx.HTTPError as e:
+            print(f"Supabase error: bulk {table} {e!r}")
+            metrics.inc("supabase_errors_total", table=table, method="BULK")
+            return False
+        finally:
+            track("supabase", table, time.perf_counter() - t0, table=table, method="BULK")
+        if r.status_code >= 400:
+            print(f"Supabase error: {r.status_code} {r.text}")
+            metrics.inc("supabase_errors_total", table=table, method="BULK")
+            return False
+        return True
+
+    async def update(self, table, data, filters, strict=False):
         params = {}
         if filters:
             params.update(filters)
-        return self._req("PATCH", table, params=params, data=data)
+        return await self._req("PATCH", table, params=params, data=data, strict=strict)
 
-    def select_eq(self, table, column, value):
-        return self.select(table, {f"{column}": f"eq.{value}"})
+    async def select_eq(self, table, column, value, strict=False):
+        return await self.select(table, {f"{column}": f"eq.{value}"}, strict=strict)
 
-    def update_eq(self, table, data, column, value):
-        return self.update(table, data, {f"{column}": f"eq.{value}"})
+    async def update_eq(self, table, data, column, value):
+        return await self.update(table, data, {f"{column}": f"eq.{value}"})
 
-db = SupabaseREST(SUPABASE_URL, SUPABASE_KEY)
+db = SupabaseREST(SUPABASE_URL, SUPABASE_KEY,
+                  max_connections=DB_MAX_CONN, max_keepalive=DB_KEEPALIVE,
+                  timeout=DB_TIMEOUT)
 
 # ══════════════════════════════════════════════════
 #  TELEGRAM API HELPERS
 # ══════════════════════════════════════════════════
-async def tg(method, data=None):
-    async with httpx.AsyncClient() as client:
-        try:
-            r = await client.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/{method}",
-                json=data or {}, timeout=15
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, запас до burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.ts = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TelegramAPI:
+    """Общий keep-alive клиент Bot API с лимитами и ретраями на 429/5xx"""
+
+    # методы, которые шлют сообщения в чат и попадают под per-chat лимит
+    SEND_METHODS = {
+        "sendMessage", "editMessageText", "sendPhoto", "sendDocument",
+        "sendSticker", "sendAnimation", "sendVideo", "copyMessage",
+        "forwardMessage",
+    }
+    # ошибки, при которых запрос точно не ушёл — только их можно повторять для отправок
+    NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, token, global_rps=30, chat_rps=1, retries=3, timeout=15,
+                 api_url="https://api.telegram.org", read_rps=100, backend=None):
+        self.base = f"{api_url}/bot{token}"
+        self.file_base = f"{api_url}/file/bot{token}"
+        # с общим backend лимиты одни на все воркеры, а не по 30/с на каждый
+        self.backend = backend or MemoryState()
+        self.global_bucket = self.backend.bucket("tg:send", global_rps)
+        # лимит ~30/с у Telegram — на рассылку; чтения не должны стоять в той же очереди
+        self.read_bucket = self.backend.bucket("tg:read", read_rps)
+        self.chat_rps = chat_rps
+        self.chat_buckets = OrderedDict()
+        self.retries = retries
+        self.timeout = timeout
+        self.me = None
+        self.client = None
+
+    async def open(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2, timeout=self.timeout,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
             )
-            return r.json()
-        except Exception as e:
-            print(f"TG API error [{method}]: {e}")
-            return {"ok": False}
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _chat_bucket(self, method, data):
+        if method not in self.SEND_METHODS or "chat_id" not in data:
+            return None
+        key = str(data["chat_id"])
+        b = self.chat_buckets.get(key)
+        if b is None:
+            b = self.chat_buckets[key] = self.backend.bucket(f"tg:chat:{key}", self.chat_rps)
+            if len(self.chat_buckets) > self.MAX_CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(key)
+        return b
+
+    async def call(self, method, data=None, limiter=None):
+        """limiter — дополнительный TokenBucket вызывающего (например, рассылки);
+        на 429 он тоже встаёт на паузу"""
+        if self.client is None:
+            await self.open()
+        data = data or {}
+        chat_bucket = self._chat_bucket(method, data)
+        res = {"ok": False}
+        for attempt in range(self.retries + 1):
+            if chat_bucket:
+                await chat_bucket.acquire()
+            if limiter:
+                await limiter.acquire()
+            bucket = self.global_bucket if method in self.SEND_METHODS else self.read_bucket
+            await bucket.acquire()
+            t0 = time.perf_counter()
+            maybe_sent = False
+            try:
+                r = await self.client.post(f"{self.base}/{method}", json=data)
+                res = r.json()
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"TG API error [{method}]: {e!r}")
+                res = {"ok": False, "error_code": 0, "description": repr(e)}
+                # таймаут ответа или обрыв: сообщение могло дойти — повтор дал бы дубль
+                maybe_sent = method in self.SEND_METHODS and not isinstance(e, self.NOT_SENT)
+            track("telegram", method, time.perf_counter() - t0, method=method)
+            if res.get("ok") or not is_transient(res) or maybe_sent:
+                if not res.get("ok"):
+                    metrics.inc("telegram_errors_total", method=method, code=res.get("error_code", 0))
+                return res
+
+            metrics.inc("telegram_errors_total", method=method, code=res.get("error_code", 0))
+            if res.get("error_code") == 429:
+                delay = float((res.get("parameters") or {}).get("retry_after", 1))
+                (chat_bucket or bucket).pause(delay)
+                if limiter:
+                    limiter.pause(delay)
+                metrics.inc("telegram_429_total", method=method)
+                print(f"TG API 429 [{method}]: retry after {delay}s")
+            else:
+                delay = min(0.5 * 2 ** attempt, 8)
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+        return res
+
+    async def download(self, file_path):
+        if self.client is None:
+            await self.open()
+        await self.read_bucket.acquire()
+        r = await self.client.get(f"{self.file_base}/{file_path}")
+        r.raise_for_status()
+        return r.content
+
+
+def is_transient(res):
+    """Ошибка временная (сеть, 429, 5xx) — ответ не означает «нет»"""
+    code = res.get("error_code", 0)
+    return code == 0 or code == 429 or code >= 500
+
+
+bot = TelegramAPI(BOT_TOKEN, global_rps=TG_GLOBAL_RPS, read_rps=TG_READ_RPS, chat_rps=TG_CHAT_RPS,
+                  retries=TG_RETRIES, timeout=TG_TIMEOUT, api_url=TG_API_URL, backend=state)
+
+async def tg(method, data=None):
+    return await bot.call(method, data)
+
+async def get_bot_id():
+    """id бота из getMe — один раз на процесс"""
+    if bot.me is None:
+        r = await tg("getMe")
+        if r.get("ok"):
+            bot.me = r["result"]
+    return (bot.me or {}).get("id", 0)
 
 async def send_msg(chat_id, text, markup=None):
     data = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
@@ -114,7 +938,13 @@ async def answer_cb(cb_id, text="", alert=False):
 # ══════════════════════════════════════════════════
 #  CHANNEL PARSER
 # ══════════════════════════════════════════════════
-async def parse_channel(channel_input):
+async def parse_channel(channel_input, known=None):
+    """Информация о канале из Bot API.
+
+    known — текущая строка channels: если фото не менялось (тот же
+    big_file_unique_id), аватарка не скачивается заново.
+    """
+    known = known or {}
     channel_input = channel_input.strip()
     if "t.me/" in channel_input:
         channel_input = "@" + channel_input.split("t.me/")[-1].split("/")[0].split("?")[0]
@@ -129,99 +959,660 @@ async def parse_channel(channel_input):
     if chat.get("type") not in ("channel", "supergroup"):
         return None
 
+    photo = chat.get("photo") or {}
     info = {
         "channel_id": chat["id"],
         "title": chat.get("title", ""),
         "username": chat.get("username", ""),
         "invite_link": "",
+        "avatar_hash": "",
+        "avatar_uid": photo.get("big_file_unique_id", ""),
         "avatar_base64": "",
         "member_count": 0,
     }
 
-    if info["username"]:
-        info["invite_link"] = f"https://t.me/{info['username']}"
-    elif chat.get("invite_link"):
-        info["invite_link"] = chat["invite_link"]
-    else:
+    async def invite_link():
+        if info["username"]:
+            return f"https://t.me/{info['username']}"
+        if chat.get("invite_link"):
+            return chat["invite_link"]
+        # exportChatInviteLink отзывает прежнюю ссылку — не дёргаем без нужды
+        if known.get("invite_link"):
+            return known["invite_link"]
         r2 = await tg("exportChatInviteLink", {"chat_id": chat["id"]})
-        if r2.get("ok"):
-            info["invite_link"] = r2["result"]
-
-    r3 = await tg("getChatMemberCount", {"chat_id": chat["id"]})
-    if r3.get("ok"):
-        info["member_count"] = r3["result"]
+        return r2["result"] if r2.get("ok") else ""
 
-    if chat.get("photo"):
-        fid = chat["photo"].get("big_file_id") or chat["photo"].get("small_file_id")
-        if fid:
-            info["avatar_base64"] = await download_file_b64(fid)
+    async def member_count():
+        r3 = await tg("getChatMemberCount", {"chat_id": chat["id"]})
+        return r3["result"] if r3.get("ok") else known.get("member_count", 0)
 
+    async def avatar():
+        if not photo:
+            return ""
+        if info["avatar_uid"] and info["avatar_uid"] == known.get("avatar_uid") \
+                and known.get("avatar_hash"):
+            return known["avatar_hash"]
+        # small (160×160) с запасом покрывает кружок 42px даже на 3x-экранах
+        fid = photo.get("small_file_id") or photo.get("big_file_id")
+        h = await fetch_avatar(fid) if fid else ""
+        if not h:
+            # не сохранилась — остаётся прежняя, а старый uid заставит
+            # попробовать снова при следующем обновлении
+            info["avatar_uid"] = known.get("avatar_uid", "")
+            return known.get("avatar_hash", "")
+        return h
+
+    info["invite_link"], info["member_count"], info["avatar_hash"] = await asyncio.gather(
+        invite_link(), member_count(), avatar())
     return info
 
-async def download_file_b64(file_id):
+async def download_file(file_id):
+    """Скачивает файл из Telegram → (bytes, mime) или (None, None)"""
     try:
         r = await tg("getFile", {"file_id": file_id})
         if not r.get("ok"):
-            return ""
+            return None, None
         path = r["result"]["file_path"]
-        url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{path}"
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url)
-            b64 = base64.b64encode(resp.content).decode()
-            mime = "image/png" if path.endswith(".png") else "image/jpeg"
-            return f"data:{mime};base64,{b64}"
-    except:
+        content = await bot.download(path)
+        mime = "image/png" if path.endswith(".png") else "image/jpeg"
+        return content, mime
+    except Exception as e:
+        print(f"TG download error: {e!r}")
+        return None, None
+
+# ══════════════════════════════════════════════════
+#  AVATARS
+# ══════════════════════════════════════════════════
+# Картинки лежат один раз в таблице avatars (hash PK, mime, data base64),
+# в channels — только avatar_hash. Отдаются через /avatars/<hash>.
+avatar_cache = TTLCache(maxsize=256, ttl=24 * 3600)
+
+def resize_avatar(content, mime):
+    if not HAS_PIL:
+        return content, mime
+    from PIL import Image
+    try:
+        img = Image.open(io.BytesIO(content)).convert("RGB")
+        if max(img.size) > AVATAR_SIZE:
+            img.thumbnail((AVATAR_SIZE, AVATAR_SIZE))
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=85, optimize=True)
+        return out.getvalue(), "image/jpeg"
+    except Exception as e:
+        print(f"Avatar resize error: {e!r}")
+        return content, mime
+
+async def store_avatar(content, mime):
+    """Сохраняет картинку по хэшу содержимого, возвращает хэш; "" — БД не приняла"""
+    content, mime = resize_avatar(content, mime)
+    h = hashlib.sha256(content).hexdigest()[:20]
+    if avatar_cache.get(h) is None:
+        ok = await db.bulk_upsert("avatars", [{
+            "hash": h, "mime": mime,
+            "data": base64.b64encode(content).decode(),
+        }], on_conflict="hash", ignore=True)
+        if not ok:
+            return ""
+        avatar_cache.set(h, (content, mime))
+    return h
+
+async def fetch_avatar(file_id):
+    content, mime = await download_file(file_id)
+    if not content:
         return ""
+    return await store_avatar(content, mime)
 
-async def check_member(channel_id, user_id):
-    r = await tg("getChatMember", {"chat_id": channel_id, "user_id": user_id})
+async def load_avatar(h):
+    item = avatar_cache.get(h)
+    if item is None:
+        rows = await db.select_eq("avatars", "hash", h)
+        if not rows:
+            return None
+        item = (base64.b64decode(rows[0]["data"]), rows[0].get("mime") or "image/jpeg")
+        avatar_cache.set(h, item)
+    return item
+
+async def migrate_avatars():
+    """Разовый перенос: каналы, у которых аватарка ещё только в avatar_base64
+    (data:image/...;base64,...), получают avatar_hash, блоб из строки убирается"""
+    rows = await db.select("channels", {"avatar_base64": "neq."},
+                           columns="channel_id,avatar_hash,avatar_base64")
+    moved = 0
+    for c in rows:
+        if c.get("avatar_hash") or not c.get("avatar_base64"):
+            continue
+        head, _, data = c["avatar_base64"].partition(",")
+        mime = head[5:].split(";")[0] if head.startswith("data:") else "image/jpeg"
+        try:
+            content = base64.b64decode(data if head.startswith("data:") else head)
+        except ValueError:
+            continue
+        h = await store_avatar(content, mime) if content else ""
+        if h and await db.update_eq("channels", {"avatar_hash": h, "avatar_base64": ""},
+                                    "channel_id", c["channel_id"]):
+            moved += 1
+    if moved:
+        channels_cache.invalidate()
+        print(f"Avatars: migrated {moved} channels from avatar_base64")
+
+def avatar_url(c):
+    return f"/avatars/{c['avatar_hash']}" if c.get("avatar_hash") else ""
+
+# Индекс подписок: события chat_member из вебхука + ответы getChatMember.
+# Пока Telegram присылает chat_member (member_tracking), любая смена статуса
+# придёт событием, поэтому записи живут MEMBER_INDEX_TTL, а getChatMember
+# нужен только для пар, которых в индексе ещё нет. Отрицательный ответ
+# опроса живёт MEMBER_NEG_TTL: «не подписан» через getChatMember бывает
+# и от ошибок вроде «user not found», события на такое может не прийти.
+member_cache = state.cache("members", maxsize=MEMBER_CACHE_SIZE, ttl=MEMBER_POS_TTL)
+member_tracking = False
+# каналы, где бота сняли с админов: событий оттуда не будет
+untracked_channels = state.cache("untracked_channels", maxsize=1000, ttl=MEMBER_INDEX_TTL)
+
+def member_key(channel_id, user_id):
+    return (str(channel_id), int(user_id))
+
+def is_subscribed(m):
+    """ChatMember → подписан ли"""
+    status = m.get("status")
+    return status in ("member", "administrator", "creator") or \
+        (status == "restricted" and m.get("is_member", False))
+
+async def check_member(channel_id, user_id, limiter=None):
+    """True/False — подписан или нет; None — Telegram не ответил (429, сеть)"""
+    key = member_key(channel_id, user_id)
+    cached = member_cache.get(key, _MISS)
+    if cached is not _MISS:
+        return cached
+
+    r = await bot.call("getChatMember", {"chat_id": channel_id, "user_id": user_id}, limiter=limiter)
     if r.get("ok"):
-        return r["result"]["status"] in ("member", "administrator", "creator")
-    return False
+        ok = is_subscribed(r["result"])
+    elif is_transient(r):
+        return None
+    else:
+        ok = False
+    if member_tracking and untracked_channels.get(str(channel_id)) is None:
+        # событие, пришедшее, пока шёл запрос, свежее ответа — его не затираем
+        if not member_cache.add(key, ok, MEMBER_INDEX_TTL if ok else MEMBER_NEG_TTL):
+            return member_cache.get(key, ok)
+    else:
+        member_cache.set(key, ok, MEMBER_POS_TTL if ok else MEMBER_NEG_TTL)
+    return ok
+
+def invalidate_members(channel_id=None):
+    """Сбросить кэш подписок — целиком или по одному каналу"""
+    if channel_id is None:
+        member_cache.clear()
+    else:
+        member_cache.drop_where(lambda k: k[0] == str(channel_id))
+
+async def check_channels(channels, user_id, limit=CHECK_CONCURRENCY, deadline=CHECK_DEADLINE):
+    """Параллельно проверяет подписку на все каналы.
+
+    Возвращает (results, timings): results[channel_id] = True/False/None,
+    timings[channel_id] = мс. Каналы, не успевшие к дедлайну, получают None.
+    """
+    # сначала индекс: если все пары известны, задачи и семафор не нужны
+    results, timings, missing = {}, {}, []
+    for ch in channels:
+        ok = member_cache.get(member_key(ch["channel_id"], user_id), _MISS)
+        if ok is _MISS:
+            missing.append(ch)
+        else:
+            results[str(ch["channel_id"])], timings[str(ch["channel_id"])] = ok, 0.0
+    if not missing:
+        return results, timings
+    sem = asyncio.Semaphore(limit)
+
+    async def one(ch):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                ok = await check_member(ch["channel_id"], user_id)
+            except Exception as e:
+                print(f"check_member error [{ch['channel_id']}]: {e!r}")
+                ok = None
+            return ok, round((time.perf_counter() - t0) * 1000, 1)
+
+    tasks = {str(ch["channel_id"]): asyncio.create_task(one(ch)) for ch in missing}
+    done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for t in pending:
+        t.cancel()
+
+    for cid, t in tasks.items():
+        if t in done:
+            results[cid], timings[cid] = t.result()
+        else:
+            results[cid], timings[cid] = None, round(deadline * 1000, 1)
+    return results, timings
 
 # ══════════════════════════════════════════════════
 #  INIT DATA VALIDATION
 # ══════════════════════════════════════════════════
-def validate_init(raw):
+# ключ зависит только от токена — считаем один раз
+WEBAPP_SECRET = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+init_cache = TTLCache(maxsize=INIT_CACHE_SIZE, ttl=INIT_MAX_AGE or 3600)
+
+def check_init(raw, now=None):
+    """Полная проверка подписи initData (без кэша)"""
     try:
-        parsed = parse_qs(raw)
-        h = parsed.get("hash", [None])[0]
+        pairs = dict(parse_qsl(raw, keep_blank_values=True))
+        h = pairs.pop("hash", None)
         if not h:
             return None
-        pairs = sorted(
-            f"{k}={unquote(v[0])}" for k, v in parsed.items() if k != "hash"
-        )
-        secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
-        check = hmac.new(secret, "\n".join(pairs).encode(), hashlib.sha256).hexdigest()
-        if check != h:
+        check_string = "\n".join(f"{k}={pairs[k]}" for k in sorted(pairs))
+        check = hmac.new(WEBAPP_SECRET, check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(check, h):
+            return None
+        auth_date = int(pairs.get("auth_date") or 0)
+        if INIT_MAX_AGE and auth_date + INIT_MAX_AGE < (now or time.time()):
             return None
-        user_raw = parsed.get("user", [None])[0]
-        return {"user": json.loads(unquote(user_raw))} if user_raw else None
+        user_raw = pairs.get("user")
+        return {"user": json.loads(user_raw), "auth_date": auth_date} if user_raw else None
     except:
         return None
 
+def validate_init(raw):
+    """Проверка initData с кэшем: одна и та же сессия WebApp проверяется один раз"""
+    if not raw:
+        return None
+    key = hashlib.blake2b(raw.encode(), digest_size=16).digest()
+    cached = init_cache.get(key)
+    if cached is not None:
+        return cached
+    now = time.time()
+    v = check_init(raw, now)
+    if v:
+        ttl = v["auth_date"] + INIT_MAX_AGE - now if INIT_MAX_AGE else None
+        init_cache.set(key, v, ttl)
+    return v
+
 # ══════════════════════════════════════════════════
 #  DB HELPERS
 # ══════════════════════════════════════════════════
-def get_or_create(tg_id, info=None):
-    rows = db.select_eq("users", "telegram_id", tg_id)
+user_cache = state.cache("users", maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# write-behind: «бронь» перехода состояния, чтобы два запроса не сделали его дважды
+transitions = state.cache("transitions", maxsize=10000, ttl=10)
+
+class DBUnavailable(Exception):
+    """Supabase не ответил — исход операции неизвестен (это не «строк нет»)"""
+
+async def get_or_create(tg_id, info=None):
+    """Юзер за один запрос: upsert по telegram_id возвращает строку всегда"""
+    # user_cache первым: с общим STATE_BACKEND в нём и изменения других воркеров
+    cached = user_cache.get(tg_id) or writes.get(tg_id)
+    if cached is not None:
+        return cached
+
+    if writes.enabled:
+        # создание уходит в буфер; читать всё равно надо — вдруг юзер уже есть
+        rows = await db.select_eq("users", "telegram_id", tg_id, strict=True)
+        if rows:
+            user_cache.set(tg_id, rows[0])
+            return rows[0]
+        if rows is not None:
+            return writes.create(tg_id, {
+                "username": (info or {}).get("username", ""),
+                "first_name": (info or {}).get("first_name", ""),
+                "last_name": (info or {}).get("last_name", ""),
+                "state": "new",
+            })
+        # БД не ответила — не знаем, новый ли он; дальше обычный путь без state
+
+    # state не шлём — иначе merge сбросит его существующему юзеру
+    u = {"telegram_id": tg_id}
+    if info:
+        u.update({
+            "username": info.get("username", ""),
+            "first_name": info.get("first_name", ""),
+            "last_name": info.get("last_name", ""),
+        })
+    rows = await db.upsert("users", u, on_conflict="telegram_id")
+    if not rows:
+        return {**u, "state": "new"}
+    user = rows[0]
+    if user.get("state") is None:
+        # у колонки нет DEFAULT — проставляем руками, только если всё ещё пусто
+        fixed = await db.update("users", {"state": "new"},
+                                {"telegram_id": f"eq.{tg_id}", "state": "is.null"})
+        user = fixed[0] if fixed else {**user, "state": "new"}
+    user_cache.set(tg_id, user)
+    return user
+
+async def update_user(tg_id, data):
+    """PATCH строки users с обновлением кэша"""
+    if writes.enabled:
+        return [writes.put(tg_id, data, base=await get_or_create(tg_id))]
+    rows = await db.update_eq("users", data, "telegram_id", tg_id)
+    if rows:
+        user_cache.set(tg_id, rows[0])
+    else:
+        user_cache.pop(tg_id)
+    return rows
+
+async def transition_user(tg_id, from_state, to_state, extra=None):
+    """Compare-and-set состояния одним PATCH (…&state=eq.<from>).
+
+    Возвращает обновлённую строку, если переход выполнен этим запросом,
+    иначе None — юзер уже в другом состоянии (или его нет). Если БД
+    не ответила — DBUnavailable.
+    """
+    if writes.enabled:
+        user = await get_or_create(tg_id)
+        # пока ждали, строку мог поменять параллельный запрос — сверяем свежую;
+        # от сравнения до записи await нет, а бронь не пускает второй такой же
+        # переход, пока первый не виден всем (в т.ч. другим воркерам)
+        user = writes.get(tg_id) or user_cache.get(tg_id) or user
+        if user.get("state") != from_state:
+            return None
+        if not transitions.add(f"{tg_id}:{from_state}", to_state):
+            return None
+        return writes.put(tg_id, {**(extra or {}), "state": to_state}, base=user)
+    rows = await db.update("users", {**(extra or {}), "state": to_state},
+                           {"telegram_id": f"eq.{tg_id}", "state": f"eq.{from_state}"}, strict=True)
+    if rows is None:
+        raise DBUnavailable("users")
     if rows:
+        user_cache.set(tg_id, rows[0])
         return rows[0]
-    u = {
-        "telegram_id": tg_id,
-        "username": (info or {}).get("username", ""),
-        "first_name": (info or {}).get("first_name", ""),
-        "last_name": (info or {}).get("last_name", ""),
-        "state": "new",
+    user_cache.pop(tg_id)
+    return None
+
+# ══════════════════════════════════════════════════
+#  WRITE-BEHIND
+# ══════════════════════════════════════════════════
+class UserWriteBuffer:
+    """Отложенная пакетная запись в users.
+
+    Изменения одного юзера сливаются в одну строку и уходят bulk-upsert'ом
+    (on_conflict=telegram_id) раз в interval секунд или по набору batch_size.
+    Каждое изменение сначала дописывается в spool-файл, поэтому после падения
+    несохранённое переигрывается при старте (at-least-once). Чтения видят
+    буфер раньше БД.
+
+    Новые юзеры идут отдельной пачкой с ignore-duplicates: если строка уже
+    есть (создал другой воркер), её state не затирается на "new".
+
+    У каждого процесса свой spool (<spool>.<pid>), чтобы воркеры uvicorn
+    не писали в один файл; при старте подбираются и файлы процессов,
+    которых уже нет.
+    """
+
+    def __init__(self, enabled=False, batch_size=500, interval=1.0, spool=None):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spool_path = spool
+        self.spool_file = f"{spool}.{os.getpid()}" if spool else None
+        self.spool = None
+        self.rows = {}    # tg_id → актуальная строка (для чтения)
+        self.dirty = {}   # tg_id → поля, ещё не записанные в БД
+        self.creates = {}  # tg_id → строка нового юзера, ещё не вставленная
+        self.wake = asyncio.Event()
+        self.task = None
+        self.closing = False
+        self.batches = 0
+
+    def get(self, tg_id):
+        return self.rows.get(tg_id) if self.enabled else None
+
+    def put(self, tg_id, fields, base=None):
+        row = {**(self.rows.get(tg_id) or base or {}), **fields, "telegram_id": tg_id}
+        self.rows[tg_id] = row
+        self.dirty[tg_id] = {**self.dirty.get(tg_id, {}), **fields, "telegram_id": tg_id}
+        self._spool({"id": tg_id, "f": fields})
+        user_cache.set(tg_id, row)
+        if len(self.dirty) >= self.batch_size:
+            self.wake.set()
+        return row
+
+    def create(self, tg_id, fields):
+        """Новый юзер: вставка без перезаписи, если строка всё-таки есть"""
+        if tg_id in self.rows:
+            return self.rows[tg_id]  # параллельный запрос уже создал (и, может, изменил)
+        row = {**fields, "telegram_id": tg_id}
+        self.rows[tg_id] = row
+        self.creates[tg_id] = row
+        self._spool({"id": tg_id, "new": row})
+        user_cache.set(tg_id, row)
+        if len(self.creates) >= self.batch_size:
+            self.wake.set()
+        return row
+
+    def _spool(self, rec):
+        if self.spool:
+            self.spool.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.spool.flush()
+
+    async def start(self):
+        if not self.enabled or self.task:
+            return
+        leftovers = []
+        if self.spool_path:
+            leftovers = self._leftovers()
+            for path in leftovers:
+                self._replay(path)
+            self.spool = open(self.spool_file, "a", encoding="utf-8")
+        await self.flush()
+        # всё непереданное уже в своём spool (flush → _compact) — чужие файлы не нужны
+        for path in leftovers:
+            if path != os.path.abspath(self.spool_file) and os.path.exists(path):
+                os.remove(path)
+        self.closing = False
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task:
+            # не cancel: пачка, которая сейчас пишется, должна дописаться
+            self.closing = True
+            self.wake.set()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+            if not self.dirty and not self.creates:
+                os.remove(self.spool_file)  # всё в БД — переигрывать нечего
+
+    def _leftovers(self):
+        """<spool> и <spool>.<pid> от прошлых запусков: свой pid или мёртвый процесс"""
+        folder, base = os.path.split(os.path.abspath(self.spool_path))
+        out = []
+        for name in os.listdir(folder):
+            suffix = name[len(base) + 1:] if name.startswith(base + ".") else ""
+            if name == base or (suffix.isdigit() and (int(suffix) == os.getpid()
+                                                      or not pid_alive(int(suffix)))):
+                out.append(os.path.join(folder, name))
+        return out
+
+    def _replay(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # недописанная строка при падении
+                tg_id = rec["id"]
+                if "new" in rec:
+                    self.creates[tg_id] = rec["new"]
+                else:
+                    self.dirty[tg_id] = {**self.dirty.get(tg_id, {}), **rec["f"], "telegram_id": tg_id}
+        if self.dirty or self.creates:
+            print(f"Write-behind: replaying {len(self.dirty | self.creates)} users from {path}")
+
+    async def _loop(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self.dirty and not self.creates:
+            return
+        # пачка считается незаписанной, пока БД не подтвердила: если flush
+        # прервут (cancel), она вернётся в буфер, а spool останется как был
+        created, self.creates = self.creates, {}
+        failed_new = created
+        try:
+            failed_new = await self._write(created, ignore=True)
+        finally:
+            self.creates = {**failed_new, **self.creates}
+        # пока строка не вставлена, merge её изменений создал бы юзера без state
+        batch = {k: v for k, v in self.dirty.items() if k not in self.creates}
+        for tg_id in batch:
+            del self.dirty[tg_id]
+        failed = batch
+        try:
+            failed = await self._write(batch)
+        finally:
+            # неудачное возвращаем в буфер под более свежие изменения
+            for tg_id, row in failed.items():
+                self.dirty[tg_id] = {**row, **self.dirty.get(tg_id, {})}
+        for tg_id in batch | created:
+            if tg_id not in self.dirty and tg_id not in self.creates:
+                self.rows.pop(tg_id, None)
+        self._compact()
+
+    async def _write(self, batch, ignore=False):
+        """bulk-upsert пачками; возвращает то, что записать не удалось"""
+        # PostgREST требует одинаковый набор ключей в пачке — группируем
+        groups = {}
+        for row in batch.values():
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        failed = {}
+        for rows in groups.values():
+            for i in range(0, len(rows), self.batch_size):
+                chunk = rows[i:i + self.batch_size]
+                if await db.bulk_upsert("users", chunk, on_conflict="telegram_id", ignore=ignore):
+                    self.batches += 1
+                else:
+                    failed.update((r["telegram_id"], r) for r in chunk)
+        return failed
+
+    def _compact(self):
+        """Переписывает spool: в нём остаётся только то, что ещё не в БД"""
+        if not self.spool:
+            return
+        self.spool.close()
+        tmp = self.spool_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for tg_id, row in self.creates.items():
+                f.write(json.dumps({"id": tg_id, "new": row}, ensure_ascii=False) + "\n")
+            for tg_id, fields in self.dirty.items():
+                f.write(json.dumps({"id": tg_id, "f": fields}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.spool_file)
+        self.spool = open(self.spool_file, "a", encoding="utf-8")
+
+    def stats(self):
+        return {"pending": len(self.dirty) + len(self.creates), "batches": self.batches}
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+writes = UserWriteBuffer(enabled=WRITE_BEHIND, batch_size=WB_BATCH_SIZE,
+                         interval=WB_FLUSH_INTERVAL, spool=WB_SPOOL)
+
+# без avatar_base64 — блоб больше не ездит в горячих запросах
+CHANNEL_COLUMNS = ("channel_id,title,username,invite_link,avatar_hash,avatar_uid,"
+                   "member_count,is_active,added_at")
+
+async def load_channels():
+    return await db.select("channels", {"is_active": "eq.true"}, order="added_at.asc",
+                           columns=CHANNEL_COLUMNS)
+
+async def load_prizes():
+    return await db.select("prizes", {"is_active": "eq.true"}, order="sort_order.asc")
+
+channels_cache = ReadThrough(load_channels, ttl=CATALOG_TTL, name="channels")
+prizes_cache = ReadThrough(load_prizes, ttl=CATALOG_TTL, name="prizes")
+
+async def get_channels():
+    return await channels_cache.get()
+
+async def get_prizes():
+    return await prizes_cache.get()
+
+# ══════════════════════════════════════════════════
+#  STATS
+# ══════════════════════════════════════════════════
+USER_STATES = ("new", "rolled", "claimed")
+
+# агрегаты PostgREST (count() с GROUP BY) на Supabase включаются отдельно:
+# ALTER ROLE authenticator SET pgrst.db_aggregates_enabled = 'true'.
+# Если выключены — статистика считается count-запросами
+stats_grouped = True
+
+async def count_groups(prizes):
+    """(всего, {state: n}, {prize_key: n}) — одним проходом по users, если БД
+    умеет агрегаты; None — БД не ответила"""
+    global stats_grouped
+    by_state, by_prize = dict.fromkeys(USER_STATES, 0), {}
+    if stats_grouped:
+        rows = await db.select("users", columns="state,prize_key,count()", strict=True)
+        if rows is not None:
+            for r in rows:
+                if r.get("state") in by_state:
+                    by_state[r["state"]] += r["count"]
+                if r.get("prize_key"):
+                    by_prize[r["prize_key"]] = by_prize.get(r["prize_key"], 0) + r["count"]
+            return sum(r["count"] for r in rows), by_state, by_prize
+    # запасной путь: по count на состояние и приз
+    counts = await asyncio.gather(
+        db.count("users"),
+        *[db.count("users", {"state": f"eq.{st}"}) for st in USER_STATES],
+        *[db.count("users", {"prize_key": f"eq.{p['key']}"}) for p in prizes],
+    )
+    if None in counts:
+        return None
+    if stats_grouped:
+        # БД отвечает, а агрегат нет — значит, он выключен; больше не пробуем
+        stats_grouped = False
+        print("Stats: PostgREST aggregates are disabled, falling back to count queries")
+    by_state.update(zip(USER_STATES, counts[1:1 + len(USER_STATES)]))
+    by_prize.update(zip((p["key"] for p in prizes), counts[1 + len(USER_STATES):]))
+    return counts[0], by_state, by_prize
+
+async def load_stats():
+    """Агрегаты по users: группировка в БД, время не зависит от числа юзеров"""
+    prizes = await db.select("prizes", order="sort_order.asc", strict=True)
+    if prizes is None:
+        return {}
+    counted = await count_groups(prizes)
+    if counted is None:
+        return {}  # пустое ReadThrough не кэширует — следующий запрос спросит заново
+    total, by_state, by_prize = counted
+    per_prize = [(p, by_prize.get(p["key"], 0)) for p in prizes]
+    played = by_state["rolled"] + by_state["claimed"]
+    return {
+        "total": total,
+        "states": by_state,
+        "rolled_pct": round(played / total * 100) if total else 0,
+        "claimed_pct": round(by_state["claimed"] / total * 100) if total else 0,
+        "prizes": per_prize,
     }
-    result = db.insert("users", u)
-    return result[0] if result else u
 
-def get_channels():
-    return db.select("channels", {"is_active": "eq.true"}, order="added_at.asc")
+stats_cache = ReadThrough(load_stats, ttl=STATS_TTL, name="stats")
 
-def get_prizes():
-    return db.select("prizes", {"is_active": "eq.true"}, order="sort_order.asc")
+async def load_users_total():
+    return await db.count("users")
+
+# для меню админки хватает одного count, без полной статистики
+users_total = ReadThrough(load_users_total, ttl=STATS_TTL, name="users_total")
+
+async def get_stats():
+    return await stats_cache.get()
 
 # ══════════════════════════════════════════════════
 #  API ENDPOINTS
@@ -233,9 +1624,10 @@ async def api_get_user(req: Request):
     if not v:
         return JSONResponse({"error": "Invalid initData"}, 401)
 
-    user = get_or_create(v["user"]["id"], v["user"])
-    channels = get_channels()
-    prizes = get_prizes()
+    # на холодном старте это три похода в БД — параллельно, а не по очереди
+    user, channels, prizes, _ = await asyncio.gather(
+        get_or_create(v["user"]["id"], v["user"]), get_channels(), get_prizes(),
+        static.ensure_built())
 
     return {
         "ok": True,
@@ -253,15 +1645,16 @@ async def api_get_user(req: Request):
                 "link": c["invite_link"] if c["invite_link"].startswith("http")
                         else f"https://t.me/{c['username']}" if c.get("username")
                         else c["invite_link"],
-                "avatar": c["avatar_base64"],
+                "avatar": avatar_url(c),
             }
             for c in channels
         ],
         "prizes": [
-            {"key": p["key"], "tgs": p["tgs_file"],
+            {"key": p["key"], "tgs": static.url(p["tgs_file"]),
              "name": p["name"], "emoji": p["emoji"]}
             for p in prizes
         ],
+        "lottie": await lottie_bundle_url(lottie_files(prizes, user), wait=WARMUP == "wait"),
     }
 
 @app.post("/api/check-subscription")
@@ -272,48 +1665,275 @@ async def api_check_sub(req: Request):
         return JSONResponse({"error": "Invalid initData"}, 401)
 
     tg_id = v["user"]["id"]
-    user = get_or_create(tg_id, v["user"])
     action = body.get("action", "check")
 
     if action == "save_roll":
-        if user["state"] != "new":
-            return JSONResponse({"error": "Already rolled"}, 400)
-        db.update_eq("users", {
-            "state": "rolled",
+        prize = {
             "prize_key": body.get("prize_key", ""),
             "prize_name": body.get("prize_name", ""),
-        }, "telegram_id", tg_id)
+        }
+        try:
+            won = await transition_user(tg_id, "new", "rolled", prize)
+            if not won:
+                # строки могло ещё не быть — создаём и пробуем ещё раз
+                user = await get_or_create(tg_id, v["user"])
+                if user["state"] == "new":
+                    won = await transition_user(tg_id, "new", "rolled", prize)
+        except DBUnavailable:
+            # переход не сделан и не проигран — клиент может повторить
+            return JSONResponse({"error": "Database unavailable"}, 503)
+        if not won:
+            return JSONResponse({"error": "Already rolled"}, 400)
         return {"ok": True, "state": "rolled"}
 
     if action == "check":
-        channels = get_channels()
-        results = {}
-        all_ok = True
-        for ch in channels:
-            ok = await check_member(ch["channel_id"], tg_id)
-            results[str(ch["channel_id"])] = ok
-            if not ok:
-                all_ok = False
+        user, channels = await asyncio.gather(
+            get_or_create(tg_id, v["user"]), get_channels())
+        results, timings = await check_channels(channels, tg_id)
+        all_ok = all(ok is True for ok in results.values())
+        unknown = [cid for cid, ok in results.items() if ok is None]
 
         new_state = user["state"]
         if all_ok and user["state"] == "rolled":
-            db.update_eq("users", {"state": "claimed"}, "telegram_id", tg_id)
-            new_state = "claimed"
+            try:
+                won = await transition_user(tg_id, "rolled", "claimed")
+                new_state = won["state"] if won else (await get_or_create(tg_id))["state"]
+            except DBUnavailable:
+                pass  # проверка прошла; claimed запишется при следующей
 
-        return {"ok": True, "all_subscribed": all_ok, "results": results, "state": new_state}
+        return {"ok": True, "all_subscribed": all_ok, "results": results,
+                "unknown": unknown, "timings": timings, "state": new_state}
 
     return JSONResponse({"error": "Unknown action"}, 400)
 
+@app.get("/avatars/{h}")
+async def api_avatar(h: str, req: Request):
+    if not h.isalnum() or len(h) > 64:
+        return Response(status_code=404)
+    headers = {
+        "ETag": f'"{h}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if req.headers.get("if-none-match") == f'"{h}"':
+        return Response(status_code=304, headers=headers)
+    item = await load_avatar(h)
+    if not item:
+        return Response(status_code=404)
+    content, mime = item
+    return Response(content, media_type=mime, headers=headers)
+
+# ══════════════════════════════════════════════════
+#  ADMIN SESSIONS
+# ══════════════════════════════════════════════════
+def is_admin(uid):
+    return uid in ADMIN_IDS
+
+class AdminSessions:
+    """Шаг диалога админки (add_channel, edit_prize:<key>) в памяти с TTL.
+
+    С persist=True состояние пишется в users.admin_state в фоне (write-behind)
+    и подхватывается оттуда после рестарта — но не читается на каждое сообщение.
+    """
+
+    def __init__(self, ttl=900, persist=False, flush_delay=2.0):
+        self.states = state.cache("admin_sessions", maxsize=1000, ttl=ttl)
+        self.persist = persist
+        self.flush_delay = flush_delay
+        self.dirty = {}
+        self.restored = set()
+        self.flush_task = None
+
+    async def get(self, uid):
+        st = self.states.get(uid)
+        if st is None and self.persist and uid not in self.restored:
+            self.restored.add(uid)
+            st = (await get_or_create(uid)).get("admin_state") or ""
+            if st:
+                self.states.set(uid, st)
+        return st or ""
+
+    def set(self, uid, step):
+        self.restored.add(uid)
+        if step:
+            self.states.set(uid, step)
+        elif self.states.pop(uid) is None and uid not in self.dirty:
+            return  # и так пусто — писать нечего
+        if self.persist:
+            self.dirty[uid] = step
+            if self.flush_task is None or self.flush_task.done():
+                self.flush_task = asyncio.create_task(self._flush_later())
+
+    def clear(self, uid):
+        self.set(uid, "")
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        dirty, self.dirty = self.dirty, {}
+        for uid, step in dirty.items():
+            await update_user(uid, {"admin_state": step})
+
+admin_sessions = AdminSessions(ttl=ADMIN_STATE_TTL, persist=ADMIN_STATE_PERSIST)
+
 # ══════════════════════════════════════════════════
 #  TELEGRAM WEBHOOK
 # ══════════════════════════════════════════════════
-@app.post("/api/webhook")
-async def webhook(req: Request):
-    body = await req.json()
+class UpdateQueue:
+    """Фоновая обработка апдейтов: N воркеров, у каждого своя очередь.
+
+    Апдейты одного чата всегда попадают к одному воркеру — порядок сохраняется.
+    Повторы (Telegram ретраит при медленном ответе) отсекаются по update_id.
+    """
+
+    def __init__(self, handler, workers=8, maxsize=1000):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queues = []
+        self.tasks = []
+        self.seen = state.cache("updates", maxsize=20000, ttl=3600)
+        self.latencies = deque(maxlen=1000)
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.tasks:
+            return
+        per_worker = max(1, self.maxsize // self.workers)
+        self.queues = [asyncio.Queue(per_worker) for _ in range(self.workers)]
+        self.tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    async def stop(self, timeout=10):
+        # даём дообработать то, что уже в очереди
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f"Webhook queue: {self.depth()} updates left unprocessed")
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @staticmethod
+    def chat_key(update):
+        for kind in ("message", "edited_message", "callback_query", "chat_member", "my_chat_member"):
+            obj = update.get(kind)
+            if not obj:
+                continue
+            chat = obj.get("chat") or (obj.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"]
+            if obj.get("from"):
+                return obj["from"]["id"]
+        return update.get("update_id", 0)
+
+    def submit(self, update):
+        """True — принят (или дубль), False — очередь переполнена"""
+        uid = update.get("update_id")
+        # add() атомарен и между воркерами: ретрай, попавший в другой процесс, тоже дубль
+        if uid is not None and not self.seen.add(uid, True):
+            self.duplicates += 1
+            return True
+        q = self.queues[hash(self.chat_key(update)) % len(self.queues)]
+        try:
+            q.put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if uid is not None:
+                self.seen.pop(uid)  # Telegram повторит — это уже не дубль
+            return False
+        return True
+
+    async def _worker(self, q):
+        while True:
+            t0, update = await q.get()
+            try:
+                await self.handler(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Webhook handler error [{update.get('update_id')}]: {e!r}")
+            finally:
+                dt = time.perf_counter() - t0
+                self.latencies.append(dt)
+                metrics.observe("webhook_update_seconds", dt)
+                q.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            return round(lat[min(len(lat) - 1, int(len(lat) * p))] * 1000, 1) if lat else 0
+
+        return {
+            "depth": self.depth(), "processed": self.processed, "failed": self.failed,
+            "duplicates": self.duplicates, "dropped": self.dropped,
+            "p50_ms": pct(0.5), "p95_ms": pct(0.95), "max_ms": pct(1.0),
+        }
+
+
+async def process_update(body):
     if "message" in body:
         await handle_message(body["message"])
     elif "callback_query" in body:
         await handle_callback(body["callback_query"])
+    elif "chat_member" in body:
+        await handle_chat_member(body["chat_member"])
+    elif "my_chat_member" in body:
+        await handle_my_chat_member(body["my_chat_member"])
+
+updates = UpdateQueue(process_update, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE)
+
+@metrics.collector
+def runtime_samples():
+    caches = {
+        "channels": channels_cache, "prizes": prizes_cache, "stats": stats_cache,
+        "users_total": users_total,
+        "members": member_cache, "users": user_cache, "init_data": init_cache,
+        "avatars": avatar_cache,
+    }
+    out = []
+    for name, c in caches.items():
+        out.append(("cache_hits_total", "counter", {"cache": name}, c.hits))
+        out.append(("cache_misses_total", "counter", {"cache": name}, c.misses))
+    qs = updates.stats()
+    out.append(("webhook_queue_depth", "gauge", {}, qs["depth"]))
+    ws = writes.stats()
+    out.append(("write_behind_pending", "gauge", {}, ws["pending"]))
+    out.append(("write_behind_batches_total", "counter", {}, ws["batches"]))
+    for k in ("processed", "failed", "duplicates", "dropped"):
+        out.append(("webhook_updates_total", "counter", {"result": k}, qs[k]))
+    return out
+
+@app.get("/metrics")
+async def api_metrics(req: Request):
+    if METRICS_TOKEN and not hmac.compare_digest(
+            req.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return Response(status_code=403)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/api/webhook")
+async def webhook(req: Request):
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            req.headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+        return JSONResponse({"ok": False}, 403)
+    try:
+        body = await req.json()
+    except ValueError:
+        return JSONResponse({"ok": False}, 400)
+    if not isinstance(body, dict) or not isinstance(body.get("update_id"), int):
+        return JSONResponse({"ok": False}, 400)
+    if not updates.submit(body):
+        # очередь забита — пусть Telegram повторит позже
+        return JSONResponse({"ok": False}, 503)
     return {"ok": True}
 
 async def handle_message(msg):
@@ -323,7 +1943,7 @@ async def handle_message(msg):
 
     if text == "/start":
         name = msg["from"].get("first_name", "Боец")
-        get_or_create(uid, msg["from"])
+        await get_or_create(uid, msg["from"])
         await send_msg(cid,
             f"🎖 <b>Привет, {name}!</b>\n\n"
             f"🇷🇺 <b>С наступающим тебя праздником — Днём Защитника Отечества!</b>\n\n"
@@ -336,27 +1956,32 @@ async def handle_message(msg):
             ]]}
         )
 
-    elif text == "/a" and uid == ADMIN_ID:
+    elif text == "/a" and is_admin(uid):
+        admin_sessions.clear(uid)
         await show_admin_menu(cid)
 
-    elif uid == ADMIN_ID:
-        user = get_or_create(ADMIN_ID)
-        st = user.get("admin_state", "")
+    elif is_admin(uid):
+        st = await admin_sessions.get(uid)
 
         if st == "add_channel":
-            await process_add_channel(cid, text)
-            db.update_eq("users", {"admin_state": ""}, "telegram_id", ADMIN_ID)
-        elif st and st.startswith("edit_prize:"):
+            admin_sessions.clear(uid)
+            await process_add_channel(cid, uid, text)
+        elif st.startswith("edit_prize:"):
+            admin_sessions.clear(uid)
             key = st.split(":")[1]
-            db.update_eq("prizes", {"name": text}, "key", key)
-            db.update_eq("users", {"admin_state": ""}, "telegram_id", ADMIN_ID)
+            await db.update_eq("prizes", {"name": text}, "key", key)
+            prizes_cache.invalidate()
             await send_msg(cid, f"✅ Приз переименован в: <b>{text}</b>")
+        elif st.startswith("broadcast:"):
+            admin_sessions.clear(uid)
+            await confirm_broadcast(cid, uid, msg, st.split(":")[1])
 
 async def show_admin_menu(cid, msg_id=None):
-    chs = get_channels()
-    prs = get_prizes()
-    users = db.select("users")
-    total = len(users)
+    chs = await get_channels()
+    prs = await get_prizes()
+    total = await users_total.get()
+    if total is None:
+        total = "—"
 
     text = (
         f"⚙️ <b>Панель администратора</b>\n\n"
@@ -364,18 +1989,24 @@ async def show_admin_menu(cid, msg_id=None):
         f"🎁 Призов: <b>{len(prs)}</b>\n"
         f"👥 Пользователей: <b>{total}</b>"
     )
+    if broadcaster.running():
+        job = await broadcaster.last()
+        if job:
+            text += "\n\n" + broadcast_status(job)
     kb = {"inline_keyboard": [
         [{"text": f"📢 Каналы ({len(chs)})", "callback_data": "adm_channels"}],
         [{"text": f"🎁 Призы ({len(prs)})", "callback_data": "adm_prizes"}],
         [{"text": "📊 Статистика", "callback_data": "adm_stats"}],
         [{"text": "🔄 Обновить каналы", "callback_data": "adm_refresh"}],
+        [{"text": "📥 Подтянуть подписки", "callback_data": "adm_backfill"}],
+        [{"text": "📣 Рассылка", "callback_data": "adm_bcast"}],
     ]}
     if msg_id:
         await edit_msg(cid, msg_id, text, kb)
     else:
         await send_msg(cid, text, kb)
 
-async def process_add_channel(cid, text):
+async def process_add_channel(cid, uid, text):
     await send_msg(cid, "⏳ Проверяю канал...")
     info = await parse_channel(text)
 
@@ -384,12 +2015,10 @@ async def process_add_channel(cid, text):
             "❌ <b>Не удалось найти канал.</b>\n\n"
             "Убедитесь что бот — администратор канала.\n"
             "Отправьте @username или ссылку ещё раз:")
-        db.update_eq("users", {"admin_state": "add_channel"}, "telegram_id", ADMIN_ID)
+        admin_sessions.set(uid, "add_channel")
         return
 
-    bot_info = await tg("getMe")
-    bot_id = bot_info["result"]["id"] if bot_info.get("ok") else 0
-    bm = await tg("getChatMember", {"chat_id": info["channel_id"], "user_id": bot_id})
+    bm = await tg("getChatMember", {"chat_id": info["channel_id"], "user_id": await get_bot_id()})
 
     if not bm.get("ok") or bm["result"]["status"] not in ("administrator", "creator"):
         await send_msg(cid,
@@ -397,17 +2026,23 @@ async def process_add_channel(cid, text):
             "Добавьте бота как админа и попробуйте снова.")
         return
 
-    existing = db.select_eq("channels", "channel_id", info["channel_id"])
+    existing = await db.select_eq("channels", "channel_id", info["channel_id"])
     if existing:
-        db.update_eq("channels", {
+        await db.update_eq("channels", {
             "title": info["title"], "username": info["username"],
-            "invite_link": info["invite_link"], "avatar_base64": info["avatar_base64"],
+            "invite_link": info["invite_link"], "avatar_hash": info["avatar_hash"],
+            "avatar_uid": info["avatar_uid"], "avatar_base64": "",
             "member_count": info["member_count"], "is_active": True,
         }, "channel_id", info["channel_id"])
     else:
-        db.insert("channels", info)
-
-    avatar = "🖼" if info["avatar_base64"] else "📢"
+        await db.insert("channels", info)
+    channels_cache.invalidate()
+    invalidate_members(info["channel_id"])
+    untracked_channels.pop(str(info["channel_id"]))
+    # подписчиков, пришедших раньше, события не покажут — спрашиваем их заранее
+    start_backfill([info])
+
+    avatar = "🖼" if info["avatar_hash"] else "📢"
     uname = f" (@{info['username']})" if info["username"] else ""
     await send_msg(cid,
         f"✅ <b>Канал добавлен!</b>\n\n"
@@ -421,22 +2056,26 @@ async def handle_callback(cb):
     cid = cb["message"]["chat"]["id"]
     mid = cb["message"]["message_id"]
 
-    if uid != ADMIN_ID:
+    if not is_admin(uid):
         await answer_cb(cb["id"], "⛔ Нет доступа", True)
         return
 
     await answer_cb(cb["id"])
+    # любая кнопка прерывает незавершённый ввод (в т.ч. «← Отмена»)
+    admin_sessions.clear(uid)
+    # живой прогресс рассылки — только пока это сообщение показывает её экран
+    broadcaster.watch(cid, mid, data.startswith("adm_bcast"))
 
     if data == "adm_menu":
         await show_admin_menu(cid, mid)
 
     elif data == "adm_channels":
-        chs = get_channels()
+        chs = await get_channels()
         text = "📢 <b>Каналы-спонсоры:</b>\n\n"
         if not chs:
             text += "Пусто. Добавьте канал."
         for i, c in enumerate(chs, 1):
-            av = "🖼" if c["avatar_base64"] else "📢"
+            av = "🖼" if c.get("avatar_hash") else "📢"
             un = f" @{c['username']}" if c["username"] else ""
             text += f"{i}. {av} <b>{c['title']}</b>{un}\n   👥 {c.get('member_count',0)}\n\n"
 
@@ -446,7 +2085,7 @@ async def handle_callback(cb):
         await edit_msg(cid, mid, text, {"inline_keyboard": btns})
 
     elif data == "adm_add_ch":
-        db.update_eq("users", {"admin_state": "add_channel"}, "telegram_id", ADMIN_ID)
+        admin_sessions.set(uid, "add_channel")
         await edit_msg(cid, mid,
             "📢 <b>Добавление канала</b>\n\n"
             "Отправьте @username канала или ссылку t.me/...\n\n"
@@ -455,9 +2094,11 @@ async def handle_callback(cb):
 
     elif data.startswith("adm_del_ch:"):
         ch_id = int(data.split(":")[1])
-        db.update_eq("channels", {"is_active": False}, "channel_id", ch_id)
+        await db.update_eq("channels", {"is_active": False}, "channel_id", ch_id)
+        channels_cache.invalidate()
+        invalidate_members(ch_id)
         # re-render
-        chs = get_channels()
+        chs = await get_channels()
         text = "📢 <b>Каналы-спонсоры:</b>\n\n"
         if not chs:
             text += "Пусто."
@@ -469,7 +2110,7 @@ async def handle_callback(cb):
         await edit_msg(cid, mid, text, {"inline_keyboard": btns})
 
     elif data == "adm_prizes":
-        prs = db.select("prizes", order="sort_order.asc")
+        prs = await db.select("prizes", order="sort_order.asc")
         text = "🎁 <b>Призы:</b>\n\n"
         for p in prs:
             s = "✅" if p["is_active"] else "❌"
@@ -483,8 +2124,8 @@ async def handle_callback(cb):
 
     elif data.startswith("adm_edit_pr:"):
         key = data.split(":")[1]
-        db.update_eq("users", {"admin_state": f"edit_prize:{key}"}, "telegram_id", ADMIN_ID)
-        p = db.select_eq("prizes", "key", key)
+        admin_sessions.set(uid, f"edit_prize:{key}")
+        p = await db.select_eq("prizes", "key", key)
         name = p[0]["name"] if p else key
         await edit_msg(cid, mid,
             f"✏️ Текущее название: <b>{name}</b>\n\nОтправьте новое:",
@@ -492,11 +2133,12 @@ async def handle_callback(cb):
 
     elif data.startswith("adm_toggle_pr:"):
         key = data.split(":")[1]
-        p = db.select_eq("prizes", "key", key)
+        p = await db.select_eq("prizes", "key", key)
         if p:
-            db.update_eq("prizes", {"is_active": not p[0]["is_active"]}, "key", key)
+            await db.update_eq("prizes", {"is_active": not p[0]["is_active"]}, "key", key)
+            prizes_cache.invalidate()
         # re-render prizes
-        prs = db.select("prizes", order="sort_order.asc")
+        prs = await db.select("prizes", order="sort_order.asc")
         text = "🎁 <b>Призы:</b>\n\n"
         for p in prs:
             s = "✅" if p["is_active"] else "❌"
@@ -509,22 +2151,31 @@ async def handle_callback(cb):
         await edit_msg(cid, mid, text, {"inline_keyboard": btns})
 
     elif data == "adm_stats":
-        users = db.select("users")
-        total = len(users)
-        new = sum(1 for u in users if u["state"] == "new")
-        rolled = sum(1 for u in users if u["state"] == "rolled")
-        claimed = sum(1 for u in users if u["state"] == "claimed")
-        recent = db.select("users", order="created_at.desc", limit=5)
+        st, recent = await asyncio.gather(
+            get_stats(),
+            db.select("users", order="created_at.desc", limit=5,
+                      columns="telegram_id,first_name,username,state,prize_name"),
+        )
+        if not st:
+            await edit_msg(cid, mid, "❌ Не удалось получить статистику",
+                           {"inline_keyboard": [[{"text": "← Назад", "callback_data": "adm_menu"}]]})
+            return
+        total, states = st["total"], st["states"]
 
         text = (
             f"📊 <b>Статистика</b>\n\n"
             f"👥 Всего: <b>{total}</b>\n"
-            f"🆕 Новые: <b>{new}</b>\n"
-            f"🎰 Крутили: <b>{rolled}</b>\n"
-            f"✅ Подписались: <b>{claimed}</b>\n\n"
-            f"📈 Конверсия: <b>{round(((rolled+claimed)/total)*100) if total else 0}%</b> крутили → "
-            f"<b>{round((claimed/total)*100) if total else 0}%</b> подписались\n"
+            f"🆕 Новые: <b>{states['new']}</b>\n"
+            f"🎰 Крутили: <b>{states['rolled']}</b>\n"
+            f"✅ Подписались: <b>{states['claimed']}</b>\n\n"
+            f"📈 Конверсия: <b>{st['rolled_pct']}%</b> крутили → "
+            f"<b>{st['claimed_pct']}%</b> подписались\n"
         )
+        won = [(p, n) for p, n in st["prizes"] if n]
+        if won:
+            text += "\n🎁 <b>Выпало призов:</b>\n"
+            for p, n in sorted(won, key=lambda x: -x[1]):
+                text += f"  • {p['emoji']} {p['name']} — {n}\n"
         if recent:
             text += "\n👤 <b>Последние:</b>\n"
             for u in recent:
@@ -534,39 +2185,743 @@ async def handle_callback(cb):
                     text += f" ({u['prize_name']})"
                 text += "\n"
 
+        cs, ps = channels_cache.stats(), prizes_cache.stats()
+        text += (
+            f"\n🗄 <b>Кэш</b> (попал/промах):\n"
+            f"  • каналы: {cs['hits']}/{cs['misses']} (v{cs['version']})\n"
+            f"  • призы: {ps['hits']}/{ps['misses']} (v{ps['version']})\n"
+            f"  • подписки: {member_cache.hits}/{member_cache.misses}\n"
+        )
+        qs = updates.stats()
+        text += (
+            f"\n📨 <b>Вебхук</b>: в очереди {qs['depth']}, "
+            f"обработано {qs['processed']}, ошибок {qs['failed']}, "
+            f"дублей {qs['duplicates']}\n"
+            f"  ⏱ p50 {qs['p50_ms']} мс · p95 {qs['p95_ms']} мс\n"
+        )
+
         await edit_msg(cid, mid, text, {"inline_keyboard": [[{"text": "← Назад", "callback_data": "adm_menu"}]]})
 
     elif data == "adm_refresh":
-        chs = get_channels()
-        ok = 0
-        for c in chs:
-            info = await parse_channel(str(c["channel_id"]))
-            if info:
-                db.update_eq("channels", {
-                    "title": info["title"], "username": info["username"],
-                    "invite_link": info["invite_link"],
-                    "avatar_base64": info["avatar_base64"],
-                    "member_count": info["member_count"],
-                }, "channel_id", c["channel_id"])
-                ok += 1
-        await show_admin_menu(cid, mid)
+        # если обновление уже идёт — его прогресс и так виден в сообщении
+        start_refresh(cid, mid)
+
+    elif data == "adm_backfill":
+        if not start_backfill(await get_channels(), cid, mid):
+            await edit_msg(cid, mid, "📥 Подписки уже подтягиваются — подождите",
+                           {"inline_keyboard": [[{"text": "← Назад", "callback_data": "adm_menu"}]]})
+
+    elif data == "adm_bcast":
+        await show_broadcast_menu(cid, mid)
+
+    elif data.startswith("adm_bcast_to:"):
+        audience = data.split(":")[1]
+        admin_sessions.set(uid, f"broadcast:{audience}")
+        await edit_msg(cid, mid,
+            f"📣 <b>Рассылка: {BCAST_AUDIENCES[audience]}</b>\n\n"
+            f"Отправьте сообщение — текст, фото, что угодно. "
+            f"Получатели увидят его копию без пометки «переслано».",
+            {"inline_keyboard": [[{"text": "← Отмена", "callback_data": "adm_bcast"}]]})
+
+    elif data == "adm_bcast_go":
+        draft = bcast_drafts.get(uid)
+        bcast_drafts.pop(uid)
+        job = None
+        if draft and not broadcaster.running():
+            job = await broadcaster.create(draft["from_chat_id"], draft["message_id"], draft["audience"])
+        if job:
+            broadcaster.start(job)
+        await show_broadcast_menu(cid, mid)
+
+    elif data.startswith("adm_bcast_resume:"):
+        job = await broadcaster.load(data.split(":")[1])
+        if job and job["status"] != "done":
+            broadcaster.start(job)
+        await show_broadcast_menu(cid, mid)
+
+    elif data == "adm_bcast_stop":
+        await broadcaster.stop()
+        await show_broadcast_menu(cid, mid)
+
+# ══════════════════════════════════════════════════
+#  CHANNEL REFRESH
+# ══════════════════════════════════════════════════
+CHANNEL_FIELDS = ("title", "username", "invite_link", "avatar_hash", "avatar_uid", "member_count")
+
+refresh_task = None
+
+def channel_diff(old, info):
+    """Только изменившиеся поля канала"""
+    diff = {f: info[f] for f in CHANNEL_FIELDS if info.get(f) != old.get(f)}
+    if "avatar_hash" in diff:
+        diff["avatar_base64"] = ""  # старый блоб из строки больше не нужен
+    return diff
+
+async def refresh_channels(progress=None, limit=REFRESH_CONCURRENCY):
+    """Параллельно перечитывает активные каналы и пишет в БД только изменения.
+
+    Возвращает список отчётов {title, status, fields, ms};
+    status: updated / unchanged / failed.
+    """
+    channels_cache.invalidate()
+    prizes_cache.invalidate()
+    chs = await get_channels()
+    sem = asyncio.Semaphore(limit)
+    done = 0
+
+    async def one(c):
+        nonlocal done
+        async with sem:
+            t0 = time.perf_counter()
+            report = {"title": c["title"], "status": "failed", "fields": []}
+            try:
+                info = await parse_channel(str(c["channel_id"]), known=c)
+                if info:
+                    diff = channel_diff(c, info)
+                    if diff:
+                        await db.update_eq("channels", diff, "channel_id", c["channel_id"])
+                    report.update(title=info["title"], status="updated" if diff else "unchanged",
+                                  fields=[f for f in diff if f != "avatar_base64"])
+            except Exception as e:
+                print(f"Refresh error [{c['channel_id']}]: {e!r}")
+            report["ms"] = round((time.perf_counter() - t0) * 1000)
+            done += 1
+            if progress:
+                await progress(done, len(chs))
+            return report
+
+    reports = await asyncio.gather(*(one(c) for c in chs))
+    channels_cache.invalidate()
+    if not member_tracking:
+        invalidate_members()  # индекс по событиям и так актуален
+    return reports
+
+def start_refresh(cid, mid):
+    """Запускает обновление в фоне; False — если оно уже идёт"""
+    global refresh_task
+    if refresh_task and not refresh_task.done():
+        return False
+    refresh_task = asyncio.create_task(run_refresh(cid, mid))
+    return True
+
+async def run_refresh(cid, mid):
+    back = {"inline_keyboard": [[{"text": "← Назад", "callback_data": "adm_menu"}]]}
+    t0 = time.perf_counter()
+    last_edit = 0.0
+
+    async def progress(done, total):
+        nonlocal last_edit
+        now = time.perf_counter()
+        if done < total and now - last_edit < 1.5:
+            return
+        last_edit = now
+        await edit_msg(cid, mid, f"🔄 <b>Обновляю каналы…</b> {done}/{total}")
+
+    try:
+        await edit_msg(cid, mid, "🔄 <b>Обновляю каналы…</b>")
+        reports = await refresh_channels(progress)
+    except Exception as e:
+        print(f"Refresh error: {e!r}")
+        await edit_msg(cid, mid, "❌ Не удалось обновить каналы", back)
+        return
+
+    icons = {"updated": "✏️", "unchanged": "➖", "failed": "❌"}
+    count = {k: sum(1 for r in reports if r["status"] == k) for k in icons}
+    text = (
+        f"🔄 <b>Каналы обновлены</b> за {time.perf_counter() - t0:.1f} с\n\n"
+        f"✏️ Изменено: <b>{count['updated']}</b> · "
+        f"➖ Без изменений: <b>{count['unchanged']}</b> · "
+        f"❌ Ошибок: <b>{count['failed']}</b>\n\n"
+    )
+    for r in reports:
+        fields = f" — {', '.join(r['fields'])}" if r["fields"] else ""
+        text += f"{icons[r['status']]} {r['title']}{fields} ({r['ms']} мс)\n"
+    await edit_msg(cid, mid, text, back)
+
+# ══════════════════════════════════════════════════
+#  MEMBERSHIP EVENTS
+# ══════════════════════════════════════════════════
+# chat_member по умолчанию не присылается — его надо перечислить в allowed_updates
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member", "my_chat_member"]
+
+backfill_task = None
+backfill_bucket = state.bucket("backfill", BACKFILL_RPS)
+
+async def ensure_webhook():
+    """Включает chat_member в allowed_updates (URL — WEBHOOK_URL или текущий)"""
+    global member_tracking
+    info = (await tg("getWebhookInfo")).get("result") or {}
+    url = WEBHOOK_URL or info.get("url")
+    if not url:
+        print("Webhook is not set: chat_member tracking is off")
+        return
+    current = info.get("allowed_updates") or []
+    # секрет getWebhookInfo не показывает, поэтому с WEBHOOK_SECRET регистрируем
+    # всегда: иначе новый секрет не дойдёт до Telegram, а вебхук ответит 403 на всё
+    if info.get("url") != url or not set(ALLOWED_UPDATES) <= set(current) or WEBHOOK_SECRET:
+        # setWebhook сбрасывает всё, что не передано, — сохраняем текущие настройки
+        data = {"url": url, "allowed_updates": sorted(set(ALLOWED_UPDATES) | set(current))}
+        for k in ("max_connections", "ip_address"):
+            if info.get(k):
+                data[k] = info[k]
+        if WEBHOOK_SECRET:
+            data["secret_token"] = WEBHOOK_SECRET
+        r = await tg("setWebhook", data)
+        if not r.get("ok"):
+            print(f"setWebhook failed: {r.get('description')}")
+            if WEBHOOK_SECRET:
+                print("WARNING: WEBHOOK_SECRET may be unregistered — updates will be rejected with 403")
+            return
+    member_tracking = True
+
+async def tracked_channel(chat_id):
+    return any(str(c["channel_id"]) == str(chat_id) for c in await get_channels())
+
+async def handle_chat_member(upd):
+    """Вступил/вышел в канале-спонсоре — сразу в индекс подписок"""
+    if not await tracked_channel(upd["chat"]["id"]):
+        return
+    m = upd["new_chat_member"]
+    ok = is_subscribed(m)
+    member_cache.set(member_key(upd["chat"]["id"], m["user"]["id"]), ok, MEMBER_INDEX_TTL)
+    metrics.inc("member_events_total", event="join" if ok else "leave")
+
+async def handle_my_chat_member(upd):
+    """Права бота в канале: без админки chat_member оттуда больше не придут"""
+    chat = upd["chat"]
+    if chat.get("type") == "private" or not await tracked_channel(chat["id"]):
+        return
+    if upd["new_chat_member"]["status"] in ("administrator", "creator"):
+        untracked_channels.pop(str(chat["id"]))
+    else:
+        print(f"Bot lost admin rights in {chat['id']}: membership index dropped for it")
+        untracked_channels.set(str(chat["id"]), True)
+        invalidate_members(chat["id"])
+
+async def backfill_members(channels, progress=None, limit=CHECK_CONCURRENCY):
+    """Заполняет индекс для юзеров, пришедших до начала отслеживания.
+
+    Идёт по users в состояниях new/rolled (им ещё предстоит проверка)
+    страницами по telegram_id и спрашивает getChatMember только для пар,
+    которых нет в индексе — в своём темпе BACKFILL_RPS, чтобы не отнимать
+    лимит у живых проверок. Возвращает (юзеров, запросов).
+    """
+    sem = asyncio.Semaphore(limit)
+    last, users, calls = 0, 0, 0
+
+    async def one(channel_id, user_id):
+        nonlocal calls
+        async with sem:
+            if member_cache.get(member_key(channel_id, user_id), _MISS) is _MISS:
+                calls += 1
+                await check_member(channel_id, user_id, limiter=backfill_bucket)
+
+    while True:
+        page = await db.select("users", {"state": "in.(new,rolled)", "telegram_id": f"gt.{last}"},
+                               order="telegram_id.asc", limit=500, columns="telegram_id")
+        if not page:
+            break
+        await asyncio.gather(*(one(c["channel_id"], r["telegram_id"]) for r in page for c in channels))
+        last = page[-1]["telegram_id"]
+        users += len(page)
+        if progress:
+            await progress(users, calls)
+    return users, calls
+
+def start_backfill(channels, cid=None, mid=None):
+    """Бэкфилл в фоне (с прогрессом в сообщении, если оно есть); False — уже идёт"""
+    global backfill_task
+    if backfill_task and not backfill_task.done():
+        return False
+    backfill_task = asyncio.create_task(run_backfill(channels, cid, mid))
+    return True
+
+async def run_backfill(channels, cid=None, mid=None):
+    back = {"inline_keyboard": [[{"text": "← Назад", "callback_data": "adm_menu"}]]}
+    t0 = time.perf_counter()
+
+    async def progress(users, calls):
+        if cid:
+            await edit_msg(cid, mid, f"📥 <b>Подтягиваю подписки…</b>\n\n"
+                                     f"Юзеров: {users} · запросов getChatMember: {calls}")
+
+    try:
+        users, calls = await backfill_members(channels, progress)
+    except Exception as e:
+        print(f"Backfill error: {e!r}")
+        if cid:
+            await edit_msg(cid, mid, "❌ Не удалось подтянуть подписки", back)
+        return
+    if cid:
+        tracking = "отслеживаются" if member_tracking else "⚠️ не отслеживаются (нет вебхука)"
+        await edit_msg(cid, mid,
+            f"📥 <b>Подписки подтянуты</b> за {time.perf_counter() - t0:.1f} с\n\n"
+            f"Юзеров: <b>{users}</b> · запросов getChatMember: <b>{calls}</b>\n"
+            f"Дальше изменения {tracking}.", back)
+
+# ══════════════════════════════════════════════════
+#  BROADCAST
+# ══════════════════════════════════════════════════
+BCAST_AUDIENCES = {"all": "👥 Всем", "new": "🆕 Новым", "rolled": "🎰 Крутившим", "claimed": "✅ Подписавшимся"}
+BCAST_FIELDS = ("status", "last_id", "total", "sent", "blocked", "failed")
+
+bcast_drafts = state.cache("bcast_drafts", maxsize=100, ttl=ADMIN_STATE_TTL)   # uid админа → сообщение для рассылки
+
+def bcast_filters(audience, after=None):
+    filters = {} if audience == "all" else {"state": f"eq.{audience}"}
+    if after is not None:
+        filters["telegram_id"] = f"gt.{after}"
+    return filters
+
+class Broadcaster:
+    """Рассылка сообщения админа (copyMessage) по users.
+
+    Получатели читаются страницами по telegram_id (keyset: gt.<последний>,
+    без offset). Отправка — concurrency параллельно через свой TokenBucket
+    на rate/с; 429 ставит его на паузу на retry_after. Прогресс (last_id и
+    счётчики) пишется в таблицу broadcasts после каждой страницы, так что
+    прерванную рассылку можно продолжить с того же места. Флаги run/stop
+    лежат в STATE_BACKEND: при нескольких воркерах рассылка идёт одна, а
+    остановить её можно из любого.
+    """
+
+    def __init__(self, rate=25, concurrency=20, page=500):
+        self.bucket = state.bucket("bcast", rate)
+        self.flags = state.cache("broadcast", maxsize=10, ttl=30)
+        self.concurrency = concurrency
+        self.page = page
+        self.job = None
+        self.task = None
+        self.active = False
+        self.stopping = False
+        self.started = 0.0
+        self.done_at_start = 0
+        self.watcher = None   # (chat_id, message_id) экрана с живым прогрессом
+
+    def running(self):
+        return self.active or self.flags.get("run") is not None
+
+    @staticmethod
+    def processed(job):
+        return job["sent"] + job["blocked"] + job["failed"]
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        if not self.running() or elapsed <= 0:
+            return 0.0
+        return (self.processed(self.job) - self.done_at_start) / elapsed
+
+    def watch(self, cid, mid, on):
+        if on:
+            self.watcher = (cid, mid)
+        elif self.watcher == (cid, mid):
+            self.watcher = None
+
+    async def create(self, from_chat_id, message_id, audience):
+        total = await db.count("users", bcast_filters(audience))
+        if total is None:
+            return None
+        rows = await db.insert("broadcasts", {
+            "audience": audience, "from_chat_id": from_chat_id, "message_id": message_id,
+            "status": "paused", "last_id": 0, "total": total,
+            "sent": 0, "blocked": 0, "failed": 0,
+        })
+        return rows[0] if rows else None
+
+    async def last(self):
+        """Текущая рассылка или последняя из БД"""
+        if self.active:
+            return self.job
+        rows = await db.select("broadcasts", order="id.desc", limit=1)
+        return rows[0] if rows else None
+
+    async def load(self, job_id):
+        rows = await db.select_eq("broadcasts", "id", job_id)
+        return rows[0] if rows else None
+
+    def start(self, job):
+        if self.active or not self.flags.add("run", os.getpid()):
+            return False
+        self.flags.pop("stop")
+        self.job, self.stopping, self.active = job, False, True
+        self.task = asyncio.create_task(self._run())
+        return True
+
+    async def stop(self, wait=False):
+        """wait=True — при выключении воркера: останавливает только свою рассылку"""
+        if not wait:
+            self.flags.set("stop", True, ttl=60)
+        self.stopping = True
+        if wait and self.task and not self.task.done():
+            await asyncio.wait([self.task], timeout=10)
+
+    async def _save(self):
+        job = self.job
+        await db.update_eq("broadcasts", {f: job[f] for f in BCAST_FIELDS}, "id", job["id"])
+
+    async def _deliver(self, uid):
+        job = self.job
+        res = await bot.call("copyMessage", {
+            "chat_id": uid, "from_chat_id": job["from_chat_id"], "message_id": job["message_id"],
+        }, limiter=self.bucket)
+        if res.get("ok"):
+            return "sent"
+        code, desc = res.get("error_code", 0), res.get("description", "")
+        if code == 400 and "message to copy not found" in desc:
+            self.stopping = True  # исходное сообщение удалено — дальше слать нечего
+            return None
+        # 403: бот заблокирован / аккаунт удалён; 400 chat not found — тоже недоставляемо
+        if code == 403 or (code == 400 and "chat not found" in desc):
+            return "blocked"
+        return "failed"
+
+    async def _run(self):
+        job = self.job
+        sem = asyncio.Semaphore(self.concurrency)
+        self.started, self.done_at_start = time.monotonic(), self.processed(job)
+        job["status"] = "running"
+        await self._save()
+        reporter = asyncio.create_task(self._report())
+
+        async def one(uid):
+            async with sem:
+                if self.stopping:
+                    return None
+                return await self._deliver(uid)
+
+        try:
+            while not self.stopping:
+                page = await db.select("users", bcast_filters(job["audience"], job["last_id"]),
+                                       order="telegram_id.asc", limit=self.page, columns="telegram_id")
+                if not page:
+                    # пустой ответ — это и конец, и ошибка БД; сверяемся с остатком
+                    # (не посчитался — тоже пауза, а не «готово»)
+                    if await db.count("users", bcast_filters(job["audience"], job["last_id"])) != 0:
+                        self.stopping = True
+                    break
+                results = await asyncio.gather(*(one(r["telegram_id"]) for r in page))
+                # курсор двигается только по непрерывно обработанному префиксу страницы
+                for r, res in zip(page, results):
+                    if res is None:
+                        break
+                    job[res] += 1
+                    job["last_id"] = r["telegram_id"]
+                    metrics.inc("broadcast_messages_total", result=res)
+                await self._save()
+            job["status"] = "paused" if self.stopping else "done"
+        except Exception as e:
+            print(f"Broadcast error [{job['id']}]: {e!r}")
+            job["status"] = "paused"
+        finally:
+            reporter.cancel()
+            await self._save()
+            self.flags.pop("run")
+            self.flags.pop("stop")
+            self.active = False
+            if self.watcher:
+                await show_broadcast_menu(*self.watcher)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(3)
+            self.flags.set("run", os.getpid())
+            if self.flags.get("stop"):
+                self.stopping = True
+            if self.watcher:
+                await show_broadcast_menu(*self.watcher)
+
+broadcaster = Broadcaster(rate=BCAST_RPS, concurrency=BCAST_CONCURRENCY, page=BCAST_PAGE)
+
+def broadcast_status(job):
+    icons = {"running": "📣 Идёт", "paused": "⏸ Пауза", "done": "✅ Завершена"}
+    done = broadcaster.processed(job)
+    text = (
+        f"{icons.get(job['status'], job['status'])}: рассылка #{job['id']} "
+        f"({BCAST_AUDIENCES.get(job['audience'], job['audience'])})\n"
+        f"  {done}/{job['total']} · ✉️ {job['sent']} · 🚫 {job['blocked']} · ❌ {job['failed']}"
+    )
+    rate = broadcaster.rate() if job is broadcaster.job else 0.0
+    if rate:
+        left = max(job["total"] - done, 0)
+        text += f"\n  ⚡ {rate:.1f} сообщ./с · осталось ~{left / rate / 60:.0f} мин"
+    return text
+
+async def show_broadcast_menu(cid, mid):
+    job = await broadcaster.last()
+    text = "📣 <b>Рассылка</b>\n\n"
+    rows = []
+    if job:
+        text += broadcast_status(job) + "\n\n"
+    if broadcaster.running():
+        rows += [[{"text": "🔄 Обновить", "callback_data": "adm_bcast"}],
+                 [{"text": "⏹ Остановить", "callback_data": "adm_bcast_stop"}]]
+    else:
+        if job and job["status"] != "done":
+            rows.append([{"text": f"▶️ Продолжить #{job['id']}", "callback_data": f"adm_bcast_resume:{job['id']}"}])
+        text += "Кому отправить новую?"
+        rows += [[{"text": label, "callback_data": f"adm_bcast_to:{aud}"}]
+                 for aud, label in BCAST_AUDIENCES.items()]
+    rows.append([{"text": "← Назад", "callback_data": "adm_menu"}])
+    await edit_msg(cid, mid, text, {"inline_keyboard": rows})
+
+async def confirm_broadcast(cid, uid, msg, audience):
+    total = await db.count("users", bcast_filters(audience))
+    if total is None:
+        await send_msg(cid, "❌ Не удалось посчитать получателей, попробуйте ещё раз")
+        return
+    bcast_drafts.set(uid, {"audience": audience, "from_chat_id": cid, "message_id": msg["message_id"]})
+    await send_msg(cid,
+        f"📣 Сообщение выше уйдёт как есть: <b>{BCAST_AUDIENCES[audience]}</b> — "
+        f"<b>{total}</b> получателей.\n\n"
+        f"Примерно {total / BCAST_RPS / 60:.0f} мин при {BCAST_RPS:g} сообщ./с.",
+        {"inline_keyboard": [
+            [{"text": "🚀 Отправить", "callback_data": "adm_bcast_go"}],
+            [{"text": "← Отмена", "callback_data": "adm_bcast"}],
+        ]})
 
 # ══════════════════════════════════════════════════
 #  STATIC FILES
 # ══════════════════════════════════════════════════
-app.mount("/assets", StaticFiles(directory="public/assets"), name="assets")
+class StaticAsset:
+    """Файл из public/ в памяти + заранее сжатые варианты"""
+
+    def __init__(self, content, mime, br_quality=11):
+        self.hash = hashlib.sha256(content).hexdigest()[:12]
+        self.mime = mime
+        self.variants = {"identity": content}
+        # .tgs — уже gzip, повторное сжатие ничего не даёт; берём вариант,
+        # только если он заметно меньше
+        gz = gzip.compress(content, 9, mtime=0)
+        if len(gz) < len(content) * 0.9:
+            self.variants["gzip"] = gz
+        if brotli is not None:
+            br = brotli.compress(content, quality=br_quality)
+            if len(br) < len(content) * 0.9:
+                self.variants["br"] = br
+
+
+class StaticIndex:
+    """Индекс статики: без stat() на каждый запрос, хэшированные URL для assets/.
+
+    assets/prize1.tgs доступен и как assets/prize1.<hash>.tgs — такой URL
+    отдаётся с immutable-кэшем на год; index.html переписывается на
+    хэшированные ссылки и всегда ревалидируется по ETag.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}   # путь → (StaticAsset, immutable)
+        self.urls = {}    # assets/x.tgs → assets/x.<hash>.tgs
+        self.built = False
+        self.lock = asyncio.Lock()
+
+    async def ensure_built(self):
+        """Собрать индекс один раз: в потоке, чтобы не держать event loop"""
+        if self.built:
+            return
+        async with self.lock:
+            if not self.built:
+                await asyncio.to_thread(self.build)
+
+    def build(self):
+        files, urls = {}, {}
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                full = os.path.join(dirpath, name)
+                rel = os.path.relpath(full, self.root).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    content = f.read()
+                mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                asset = StaticAsset(content, mime)
+                files[rel] = (asset, False)
+                if rel != "index.html":
+                    stem, ext = os.path.splitext(rel)
+                    hashed = f"{stem}.{asset.hash}{ext}"
+                    files[hashed] = (asset, True)
+                    urls[rel] = hashed
+
+        if "index.html" in files:
+            html = files["index.html"][0].variants["identity"].decode()
+            for rel, hashed in urls.items():
+                html = html.replace(f'"{rel}"', f'"{hashed}"')
+            files["index.html"] = (StaticAsset(html.encode(), "text/html; charset=utf-8"), False)
+
+        self.files, self.urls, self.built = files, urls, True
+
+    def url(self, path):
+        """Хэшированный URL; до ensure_built() — исходный путь (он тоже отдаётся)"""
+        return self.urls.get(path.lstrip("/"), path)
+
+    async def response(self, path, req):
+        await self.ensure_built()
+        entry = self.files.get(path)
+        # SPA: незнакомый путь — index.html, но не под assets/ (клиент ждёт .tgs, а не HTML)
+        if entry is None and not path.startswith("assets/"):
+            entry = self.files.get("index.html")
+        if entry is None:
+            return Response(status_code=404)
+        asset, immutable = entry
+
+        return asset_response(asset, immutable, req)
+
+
+def asset_response(asset, immutable, req):
+    """Ответ с подходящим сжатым вариантом, ETag и Cache-Control"""
+    accept = req.headers.get("accept-encoding", "")
+    enc = next((e for e in ("br", "gzip") if e in asset.variants and e in accept), "identity")
+    headers = {
+        "ETag": f'"{asset.hash}"' if enc == "identity" else f'"{asset.hash}-{enc}"',
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "public, max-age=31536000, immutable" if immutable
+                         else "no-cache" if asset.mime.startswith("text/html")
+                         else "public, max-age=300",
+    }
+    if asset.hash in req.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if enc != "identity":
+        headers["Content-Encoding"] = enc
+    return Response(asset.variants[enc], media_type=asset.mime, headers=headers)
+
 
+static = StaticIndex(PUBLIC_DIR)
+
+# ══════════════════════════════════════════════════
+#  LOTTIE BUNDLE
+# ══════════════════════════════════════════════════
+# Вместо 14 запросов за .tgs и pako.inflate на клиенте — один JSON со всеми
+# нужными анимациями: уже распакованными, без служебных полей, с округлением.
+LOTTIE_MAIN = "assets/gift.tgs"
+LOTTIE_STRIP = {"nm", "mn", "ix", "cl", "meta"}  # имена/индексы для редакторов и expressions
+
+lottie_bundles = TTLCache(maxsize=64, ttl=7 * 24 * 3600)   # hash → StaticAsset
+lottie_sets = TTLCache(maxsize=64, ttl=7 * 24 * 3600)      # набор файлов → hash
+lottie_lock = asyncio.Lock()
+lottie_builds = set()   # фоновые сборки (ссылки, чтобы задачи не собрал GC)
+
+def load_lottie(raw, precision=LOTTIE_PRECISION, scale=1.0):
+    """Разбирает и чистит Lottie JSON за один json.loads; scale != 1 пересчитывает
+    время под новый fps.
+
+    Округление — в parse_float, лишние ключи — в object_hook: обход дерева
+    делает C-парсер, а не рекурсия на Python (на холодном старте вдвое быстрее).
+    """
+    def num(v):
+        if precision:
+            v = round(v, precision)
+        return int(v) if v.is_integer() else v
+
+    def obj(node):
+        for k in [k for k, v in node.items() if k in LOTTIE_STRIP or (k == "hd" and v is False)]:
+            del node[k]
+        if scale != 1:
+            for k in ("ip", "op", "st", "t"):
+                v = node.get(k)
+                # t — время только у кадра; у градиента (ty gf/gs) t — его тип
+                if isinstance(v, (int, float)) and not isinstance(v, bool) and (
+                        k != "t" or "ty" not in node):
+                    node[k] = num(float(v) * scale)
+        return node
+
+    return json.loads(raw, parse_float=lambda s: num(float(s)), object_hook=obj)
+
+def build_lottie_bundle(files):
+    """{"items": {url: строка Lottie JSON}} — клиенту не нужно ничего распаковывать"""
+    items = {}
+    for path in files:
+        entry = static.files.get(path)
+        if not entry:
+            continue
+        raw = gzip.decompress(entry[0].variants["identity"])
+        scale = 1.0
+        if LOTTIE_FPS:
+            # fr нужен до разбора; лишний json.loads — только при пересчёте fps
+            fr = json.loads(raw).get("fr", 0)
+            if fr > LOTTIE_FPS:
+                scale = LOTTIE_FPS / fr
+        data = load_lottie(raw, LOTTIE_PRECISION, scale)
+        if scale != 1:
+            data["fr"] = LOTTIE_FPS
+        items[static.url(path)] = json.dumps(data, separators=(",", ":"))
+    body = json.dumps({"items": items}, ensure_ascii=False, separators=(",", ":"))
+    # бандл в мегабайты: brotli 11 слишком медленный для сборки на лету
+    return StaticAsset(body.encode(), "application/json", br_quality=8)
+
+def lottie_files(prizes, user=None):
+    """Какие анимации нужны: новому юзеру — подарок и все призы, иначе только его приз"""
+    if user and user.get("state") != "new":
+        return [p["tgs_file"] for p in prizes if p["key"] == user.get("prize_key")]
+    return [LOTTIE_MAIN] + [p["tgs_file"] for p in prizes]
+
+async def lottie_bundle_url(files, wait=True):
+    """URL бандла; wait=False — если его ещё нет, собрать в фоне и вернуть ""
+    (клиент возьмёт .tgs по одному, бандл будет к следующему заходу)"""
+    if not files:
+        return ""
+    await static.ensure_built()
+    key = tuple(sorted(set(f.lstrip("/") for f in files)))
+    h = lottie_sets.get(key)
+    if h is None or lottie_bundles.get(h) is None:
+        if not wait:
+            if not lottie_lock.locked():
+                task = asyncio.create_task(lottie_bundle_url(files))
+                lottie_builds.add(task)
+                task.add_done_callback(lottie_builds.discard)
+            return ""
+        async with lottie_lock:
+            h = lottie_sets.get(key)
+            if h is None or lottie_bundles.get(h) is None:
+                asset = await asyncio.to_thread(build_lottie_bundle, key)
+                h = asset.hash
+                lottie_bundles.set(h, asset)
+                lottie_sets.set(key, h)
+    return f"/bundles/lottie.{h}.json"
+
+@app.get("/bundles/lottie.{h}.json")
+async def api_lottie_bundle(h: str, req: Request):
+    asset = lottie_bundles.get(h)
+    if asset is None:
+        # бандл мог собрать другой воркер или процесс до рестарта
+        await lottie_bundle_url(lottie_files(await get_prizes()))
+        asset = lottie_bundles.get(h)
+    if asset is None:
+        return Response(status_code=404)
+    return asset_response(asset, True, req)
+
+# ══════════════════════════════════════════════════
+#  STARTUP
+# ══════════════════════════════════════════════════
+async def warmup():
+    """Всё, что иначе досталось бы первому /api/get-user, — параллельно.
+
+    Каталоги заодно открывают соединения в пул Supabase, getMe — к Bot API;
+    статика и lottie-бандл нового юзера собираются в потоке.
+    """
+    t0 = time.perf_counter()
+
+    async def assets():
+        _, prizes = await asyncio.gather(static.ensure_built(), get_prizes())
+        await lottie_bundle_url(lottie_files(prizes))
+
+    results = await asyncio.gather(assets(), get_channels(), get_bot_id(), return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            print(f"Warmup error: {r!r}")
+    metrics.observe("warmup_seconds", time.perf_counter() - t0)
+
+# ══════════════════════════════════════════════════
+#  STATIC ROUTES
+# ══════════════════════════════════════════════════
 @app.get("/")
-async def root():
-    return FileResponse("public/index.html")
+async def root(req: Request):
+    return await static.response("index.html", req)
 
 @app.get("/{path:path}")
-async def catch_all(path: str):
-    fp = f"public/{path}"
-    if os.path.isfile(fp):
-        return FileResponse(fp)
-    return FileResponse("public/index.html")
+async def catch_all(path: str, req: Request):
+    return await static.response(path, req)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8888)
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and not state.shared:
+        print("WEB_CONCURRENCY > 1 with STATE_BACKEND=memory: caches and Telegram limits are per worker")
+    uvicorn.run("server:app" if workers > 1 else app, host="0.0.0.0", port=8888, workers=workers)
\ No newline at end of file